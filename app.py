@@ -1,14 +1,20 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from services.ga4.runner import run_ga, get_mode_counts
+from services.ga4.loader import ensure_indexes
 from datetime import datetime
 from db.mongo import init_mongo, get_db
 from dotenv import load_dotenv
-from services.queue.setup import ga_queue
 from services.queue.task_wrapper import enqueueable_run
+from services.queue.fanout import should_fan_out, enqueue_fanout, get_children_progress
+from services.queue.resume import resume_job, ResumeError
+from services.queue import coalesce, scheduler
+from services.ga4 import telemetry
+from services.ga4.reader import DataQuery, QueryError, encode_cursor, cached_page, cache_page
 from uuid import uuid4
+import json
 import os
 
-from config import GA_JOBS
+from config import GA_JOBS, GA4_PROPERTY_ID, GA_PROPERTY_IDS
 from services.queue.setup import redis_conn
 from rq.job import Job, NoSuchJobError
 
@@ -24,11 +30,13 @@ load_dotenv()  # loads .env if present
 
 app = Flask(__name__)
 
-db = get_db()
-jobs_collection = db[GA_JOBS]
-
 # Initialize Mongo (will raise if MONGO_URI not set or unreachable)
 init_mongo()
+ensure_indexes()
+
+def _jobs_collection():
+    # per call, so gunicorn workers forked after this import use their own connection
+    return get_db()[GA_JOBS]
 
 @app.route('/health/', methods=['GET'])
 def health():
@@ -60,10 +68,13 @@ def ga_status(job_id):
         elif job.is_failed:
             resp["error_info"] = str(job.exc_info)
 
+        progress = get_children_progress(job_id)
+        if progress:
+            resp["progress"] = progress
         return jsonify(resp)
 
     # Fallback to MongoDB if not found in Redis
-    job_db = jobs_collection.find_one({"_id": job_id})
+    job_db = _jobs_collection().find_one({"_id": job_id})
     if not job_db:
         return jsonify({"error": "job_not_found"}), 404
 
@@ -75,37 +86,185 @@ def ga_status(job_id):
         "started_at": str(job_db.get("started_at")),
         "ended_at": str(job_db.get("completed_at")),
     }
+    if job_db.get("checkpoints"):
+        resp["checkpoints"] = {d: c.get("status") for d, c in sorted(job_db["checkpoints"].items())}
+    # Fanned-out parents report progress from their chunk jobs
+    progress = get_children_progress(job_id)
+    if progress:
+        resp["progress"] = progress
     return jsonify(resp)
 
-@app.route('/ga/run', methods=['POST'])
-def run():
-    data = request.get_json() or {}
-    mode = data.get('mode', 'combined')
-    start_date = data.get('start_date')
-    end_date = data.get('end_date')
-
+def _enqueue_run(mode, start_date, end_date, incremental, property_id):
+    """Coalesce, record and enqueue one property's run. Returns (response body, status code)."""
     job_id = str(uuid4())
 
+    # An identical request already in flight answers this one; an overlapping
+    # combined range only syncs the dates no in-flight job covers
+    claim = coalesce.claim(job_id, mode, start_date, end_date, incremental, property_id)
+    if claim.existing_job_id:
+        return {
+            "message": "GA run already in flight",
+            "job_id": claim.existing_job_id,
+            "property_id": property_id,
+            "status": "coalesced"
+        }, 200
+    if claim.fully_covered:
+        return {
+            "message": "GA run already covered by in-flight jobs",
+            "job_ids": sorted(set(claim.covered_by.values())),
+            "property_id": property_id,
+            "status": "coalesced"
+        }, 200
+    dates = None
+    if claim.covered_by:
+        start_date, end_date = claim.dates[0], claim.dates[-1]
+        span = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+        # a gap in the middle means an explicit date list instead of a range
+        dates = claim.dates if span != len(claim.dates) else None
+
     # store job metadata immediately
-    jobs_collection.insert_one({
+    job_doc = {
         "_id": job_id,
         "mode": mode,
         "start_date": start_date,
         "end_date": end_date,
+        "incremental": incremental,
+        "property_id": property_id,
         "status": "queued",
         "created_at": datetime.now(),
         "updated_at": datetime.now(),
-    })
-
-    # Enqueue the wrapper (it will dynamically call your real runner)
-    ga_queue.enqueue(enqueueable_run, mode, start_date, end_date, queue_job_id=job_id, job_timeout=1000)
+    }
+    if claim.covered_by:
+        job_doc["covered_by"] = claim.covered_by
+    if dates:
+        job_doc["dates"] = dates
+    _jobs_collection().insert_one(job_doc)
 
     # immediate response, non-blocking
-    return jsonify({
+    resp = {
         "message": "GA run enqueued",
         "job_id": job_id,
+        "property_id": property_id,
         "status": "queued"
-    }), 202
+    }
+    if claim.covered_by:
+        resp["start_date"], resp["end_date"] = start_date, end_date
+        resp["covered_by"] = sorted(set(claim.covered_by.values()))
+        if dates:
+            resp["dates"] = dates
+
+    # Large combined ranges are split into chunk jobs so idle workers can share them
+    if not incremental and not dates and should_fan_out(mode, start_date, end_date):
+        children = enqueue_fanout(job_id, mode, start_date, end_date, job_timeout=1000, property_id=property_id)
+        resp["chunks"] = len(children)
+        return resp, 202
+
+    # Enqueue the wrapper (it will dynamically call your real runner); it waits for
+    # a free slot of its property if that property already has jobs running
+    scheduler.submit(property_id, enqueueable_run, (mode, start_date, end_date),
+                     {"queue_job_id": job_id, "incremental": incremental, "dates": dates, "property_id": property_id},
+                     job_timeout=1000)
+    return resp, 202
+
+@app.route('/ga/run', methods=['POST'])
+def run():
+    """
+    Enqueue a sync. property_id (default GA4_PROPERTY_ID) may be a list, which
+    enqueues one job per property and answers {"jobs": [...]}.
+    """
+    data = request.get_json() or {}
+    mode = data.get('mode', 'combined')
+    start_date = data.get('start_date')
+    end_date = data.get('end_date')
+    incremental = bool(data.get('incremental', False))
+
+    requested = data.get('property_id') or GA4_PROPERTY_ID
+    # no property at all runs simulated, as without GA credentials
+    properties = [str(p) if p else None for p in (requested if isinstance(requested, list) else [requested])]
+    if GA_PROPERTY_IDS:
+        unknown = [p or 'none given' for p in properties if p not in GA_PROPERTY_IDS]
+        if unknown:
+            return jsonify({"error": f"unknown property_id: {', '.join(unknown)}"}), 400
+
+    if not isinstance(requested, list):
+        resp, status = _enqueue_run(mode, start_date, end_date, incremental, properties[0])
+        return jsonify(resp), status
+    results = [_enqueue_run(mode, start_date, end_date, incremental, p) for p in dict.fromkeys(properties)]
+    return jsonify({"jobs": [resp for resp, _ in results]}), max(status for _, status in results)
+
+@app.route('/ga/resume/<job_id>', methods=['POST'])
+def resume(job_id):
+    """Re-enqueue only the dates of a job that have not been checkpointed as done."""
+    data = request.get_json(silent=True) or {}
+    try:
+        summary = resume_job(job_id, job_timeout=1000, force=bool(data.get('force', False)))
+    except ResumeError as e:
+        if str(e) == 'job_not_found':
+            return jsonify({"error": "job_not_found"}), 404
+        return jsonify({"error": str(e)}), 409
+    return jsonify(summary), 202 if summary["resumed"] else 200
+
+# query arguments of /ga/data that are not dimension filters
+_DATA_ARGS = ('collection', 'start_date', 'end_date', 'metrics', 'cursor', 'limit', 'format')
+
+def _ndjson(query, limit):
+    """Stream rows as NDJSON; with a limit, a last {"next_cursor"} line tells where to continue."""
+    count = 0
+    last = None
+    for row in query.rows(limit + 1 if limit else 0):
+        if limit and count == limit:
+            yield json.dumps({'next_cursor': encode_cursor(last, query.keys)}) + '\n'
+            return
+        count += 1
+        last = row
+        yield json.dumps(row, default=str) + '\n'
+
+@app.route('/ga/data', methods=['GET'])
+def data():
+    """
+    Read synced rows: ?collection=combined_dimensions|ga_<dimension>&start_date=&end_date=
+    &metrics=a,b&<dimension>=v1,v2&limit=&cursor=, as a JSON page with next_cursor, or
+    with format=ndjson (or Accept: application/x-ndjson) as a stream of all matching rows
+    (limit rows when given). Responses carry an ETag; If-None-Match answers 304.
+    """
+    args = request.args
+    filters = {k: v.split(',') for k, v in args.items() if k not in _DATA_ARGS}
+    ndjson = args.get('format') == 'ndjson' or (
+        request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+    try:
+        query = DataQuery(args.get('collection', 'combined_dimensions'), start_date=args.get('start_date'),
+                          end_date=args.get('end_date'), filters=filters,
+                          metrics=[m for m in args.get('metrics', '').split(',') if m], cursor=args.get('cursor'),
+                          limit=args.get('limit'))
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
+
+    etag = query.etag() + ('-ndjson' if ndjson else '')
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    if ndjson:
+        resp = Response(stream_with_context(_ndjson(query, query.limit if args.get('limit') else 0)),
+                        mimetype='application/x-ndjson')
+    else:
+        page = cached_page(etag)
+        if page is None:
+            page = query.page()
+            cache_page(etag, page)
+        resp = jsonify(page)
+    resp.set_etag(etag)
+    return resp
+
+@app.route('/ga/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Waiting and active jobs of each property with jobs waiting for a slot."""
+    return jsonify(scheduler.get_scheduler_stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint: per-stage timings and GA call counts summed over all workers."""
+    return Response(telemetry.render_prometheus(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/ga/counts', methods=['GET'])
 def counts():
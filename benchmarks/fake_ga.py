@@ -0,0 +1,178 @@
+"""
+Local stand-ins for the GA4 Data API used by the benchmarks:
+
+- make_response(): a synthetic RunReportResponse with a chosen row count,
+  dimension cardinality and metric types, built as real protobuf messages so
+  the conversion code runs exactly as it does on GA data;
+- FakeGAClient: answers run_report / batch_run_reports with such responses
+  after a configurable latency, and raises quota errors at a configurable rate.
+  install() makes services.ga4.client hand it out instead of the real client.
+
+Requires google-analytics-data (for the message types), not network access.
+"""
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# Metric names that GA reports as integers; every other metric defaults to TYPE_FLOAT
+_INTEGER_HINTS = ('Users', 'users', 'sessions', 'Sessions', 'Count', 'count', 'Clicks', 'Impressions', 'views')
+
+
+def _types():
+    from services.ga4.client import ga_types
+    return ga_types()
+
+
+def default_metric_type(metric):
+    if metric.endswith(('Rate', 'Duration', 'Position', 'PerUser')):
+        return 'TYPE_FLOAT'
+    return 'TYPE_INTEGER' if any(hint in metric for hint in _INTEGER_HINTS) else 'TYPE_FLOAT'
+
+
+def _metric_value(rng, metric_type):
+    if metric_type == 'TYPE_INTEGER':
+        return str(rng.randrange(0, 100000))
+    if metric_type == 'TYPE_SECONDS':
+        return f'{rng.random() * 600:.6f}'
+    if metric_type == 'TYPE_CURRENCY':
+        return f'{rng.random() * 1000:.2f}'
+    return f'{rng.random():.9f}'
+
+
+def make_response(dimensions, metrics, rows, cardinality=50, metric_types=None, seed=0, dates=None):
+    """
+    Build a RunReportResponse with `rows` rows per date. Every row is a distinct
+    combination of dimension values, each dimension taking up to `cardinality`
+    values, so rows is capped at cardinality ** (number of non-date dimensions).
+    A 'date' dimension takes its values (YYYYMMDD) from `dates`, in order.
+    metric_types maps metric name -> MetricType name (TYPE_INTEGER, TYPE_FLOAT,
+    TYPE_SECONDS, TYPE_CURRENCY); unlisted metrics get default_metric_type().
+    """
+    types = _types()
+    metric_types = {m: (metric_types or {}).get(m) or default_metric_type(m) for m in metrics}
+    other_dims = [d for d in dimensions if d != 'date']
+    rows = min(rows, cardinality ** max(1, len(other_dims)))
+    dates = dates if 'date' in dimensions else [None]
+    rng = random.Random(seed)
+
+    pb = types.RunReportResponse.pb()()
+    for d in dimensions:
+        pb.dimension_headers.add(name=d)
+    for m in metrics:
+        pb.metric_headers.add(name=m, type_=types.MetricType[metric_types[m]])
+    for date_str in dates:
+        for i in range(rows):
+            row = pb.rows.add()
+            # mixed-radix digits of i: a distinct value combination per row
+            n = i
+            for d in dimensions:
+                if d == 'date':
+                    row.dimension_values.add(value=date_str.replace('-', ''))
+                    continue
+                row.dimension_values.add(value=f'{d}_{n % cardinality}')
+                n //= cardinality
+            for m in metrics:
+                row.metric_values.add(value=_metric_value(rng, metric_types[m]))
+    pb.row_count = len(pb.rows)
+    return types.RunReportResponse.wrap(pb)
+
+
+def _page(full, offset, limit):
+    types = _types()
+    src = types.RunReportResponse.pb(full)
+    pb = types.RunReportResponse.pb()()
+    pb.dimension_headers.extend(src.dimension_headers)
+    pb.metric_headers.extend(src.metric_headers)
+    pb.rows.extend(src.rows[offset:offset + limit] if limit else src.rows[offset:])
+    pb.row_count = src.row_count
+    return types.RunReportResponse.wrap(pb)
+
+
+def _date_list(start_date, end_date):
+    try:
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        # relative dates ('7daysAgo', 'today'): one synthetic day
+        return [datetime.now().strftime('%Y-%m-%d')]
+    dates = []
+    while start <= end:
+        dates.append(start.strftime('%Y-%m-%d'))
+        start += timedelta(days=1)
+    return dates
+
+
+class FakeGAClient:
+    """
+    In-process GA4 Data API with the client methods the runner uses.
+    rows_per_report rows are returned per report (per day for 'date' reports),
+    paged by the request's limit/offset; each call sleeps latency seconds
+    (+/- jitter), and a quota_error_rate share of calls fail with ResourceExhausted.
+    Full reports are generated once per request shape and kept, so repeated runs
+    measure the service rather than the generator.
+    """
+
+    def __init__(self, rows_per_report=1000, cardinality=50, latency=0.05, jitter=0.0, quota_error_rate=0.0,
+                 metric_types=None, seed=0):
+        self.rows_per_report = rows_per_report
+        self.cardinality = cardinality
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.metric_types = metric_types
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reports = {}
+        self.stats = {'calls': 0, 'reports': 0, 'quota_errors': 0}
+
+    def _call(self):
+        with self.lock:
+            self.stats['calls'] += 1
+            calls = self.stats['calls']
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            # evenly spaced rather than random, so short runs see the configured rate too
+            fail = int(calls * self.quota_error_rate) > int((calls - 1) * self.quota_error_rate)
+        time.sleep(delay)
+        if fail:
+            from services.ga4.client import api_exceptions
+            with self.lock:
+                self.stats['quota_errors'] += 1
+            raise api_exceptions().ResourceExhausted('fake GA: quota exhausted')
+
+    def _report(self, request):
+        dims = tuple(d.name for d in request.dimensions)
+        mets = tuple(m.name for m in request.metrics)
+        date_range = request.date_ranges[0]
+        key = (dims, mets, date_range.start_date, date_range.end_date)
+        with self.lock:
+            self.stats['reports'] += 1
+            full = self.reports.get(key)
+        if full is None:
+            full = make_response(list(dims), list(mets), self.rows_per_report, cardinality=self.cardinality,
+                                 metric_types=self.metric_types, seed=zlib.crc32(repr(key).encode()),
+                                 dates=_date_list(date_range.start_date, date_range.end_date))
+            with self.lock:
+                self.reports[key] = full
+        return _page(full, request.offset, request.limit)
+
+    def run_report(self, request):
+        self._call()
+        return self._report(request)
+
+    def batch_run_reports(self, request):
+        self._call()
+        types = _types()
+        return types.BatchRunReportsResponse(reports=[self._report(r) for r in request.requests])
+
+
+def install(fake):
+    """Make services.ga4.client return `fake` as the GA client; returns an undo function."""
+    from services.ga4 import client
+    original = client.get_client
+    client.get_client = lambda: fake
+
+    def undo():
+        client.get_client = original
+    return undo
@@ -0,0 +1,125 @@
+"""
+Startup benchmark: cold import time of the API and worker entry points, and the
+per-job overhead of a worker (runner lookup, fork of the job process).
+
+    python benchmarks/startup.py [--repeat 5] [--forks 20]
+
+Every import is timed in a fresh interpreter. Importing `app` connects to Mongo
+(init_mongo + ensure_indexes), so it is reported as failed when Mongo is down.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# entry points, then the GA modules the code now imports on first use only
+IMPORTS = [
+    'services.ga4.runner',
+    'services.queue.task_wrapper',
+    'app',
+    'google.analytics.data_v1beta.types',
+    'google.analytics.data_v1beta',
+]
+
+_IMPORT_SNIPPET = 'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+
+# Runs in a fresh interpreter: optionally preload, then fork `forks` job processes
+# that each resolve the runner, like an RQ work horse; prints mean fork-to-ready seconds.
+_FORK_SNIPPET = '''
+import os, sys, time
+sys.path.insert(0, {root!r})
+if {preload}:
+    from services.queue.task_wrapper import preload
+    preload()
+total = 0.0
+for _ in range({forks}):
+    r, w = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        from services.queue.task_wrapper import _get_runner
+        _get_runner()
+        os.write(w, b'x')
+        os._exit(0)
+    os.read(r, 1)
+    total += time.perf_counter() - start
+    os.waitpid(pid, 0)
+    os.close(r); os.close(w)
+print(total / {forks})
+'''
+
+
+def _run(code):
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+    if proc.returncode:
+        raise RuntimeError((proc.stderr.strip().splitlines() or ['failed'])[-1])
+    return float(proc.stdout.strip().splitlines()[-1])
+
+
+def _median_ms(samples):
+    return round(statistics.median(samples) * 1000, 1)
+
+
+def bench_imports(repeat):
+    results = {}
+    for module in IMPORTS:
+        try:
+            results[module] = _median_ms([_run(_IMPORT_SNIPPET.format(module=module)) for _ in range(repeat)])
+        except RuntimeError as e:
+            results[module] = f'failed: {e}'
+    return results
+
+
+def bench_runner_lookup(calls=1000):
+    """Per-job cost of finding the runner: the old import + signature per job vs the cached lookup."""
+    import inspect
+    from services.queue import task_wrapper
+    task_wrapper._get_runner()
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn = task_wrapper._get_callable()
+        inspect.signature(fn)
+    uncached = (time.perf_counter() - start) / calls
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        task_wrapper._get_runner()
+    cached = (time.perf_counter() - start) / calls
+    return {'per_job_lookup_us': round(uncached * 1e6, 2), 'cached_lookup_us': round(cached * 1e6, 2)}
+
+
+def bench_forks(forks):
+    if not hasattr(os, 'fork'):
+        return {}
+    results = {}
+    for preload in (False, True):
+        key = 'fork_to_ready_ms_preloaded' if preload else 'fork_to_ready_ms_cold'
+        try:
+            results[key] = round(_run(_FORK_SNIPPET.format(root=ROOT, preload=preload, forks=forks)) * 1000, 2)
+        except RuntimeError as e:
+            results[key] = f'failed: {e}'
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per import timing')
+    parser.add_argument('--forks', type=int, default=20, help='job processes forked per fork timing')
+    args = parser.parse_args()
+
+    print('cold import (median ms):')
+    for module, value in bench_imports(args.repeat).items():
+        print(f'  {module:40} {value}')
+    print('per job:')
+    for name, value in {**bench_runner_lookup(), **bench_forks(args.forks)}.items():
+        print(f'  {name:40} {value}')
+
+
+if __name__ == '__main__':
+    main()
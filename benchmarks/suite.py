@@ -0,0 +1,330 @@
+"""
+Offline performance suite: conversion, Mongo writes and full run_ga runs against
+a local fake GA (benchmarks/fake_ga.py) and a local or in-process Mongo.
+
+    python benchmarks/suite.py [--quick] [--mongo-uri mongodb://localhost:27017]
+                               [--baseline benchmarks/baseline.json] [--save-baseline]
+
+Reports rows/s, p50/p99 latency and peak Python memory (tracemalloc) per case,
+and the bytes stored per row by each combined_dimensions layout (COMBINED_STORAGE).
+Without --mongo-uri, Mongo is mongomock (pip install mongomock), whose writes are
+far slower than mongod's, so write-heavy cases run with small volumes; with it, the
+suite drops every collection of its database between cases, so it never uses
+MONGO_DB: it uses BENCHMARK_MONGO_DB (default 'ga_benchmark'), and refuses to run
+unless that name contains 'benchmark'. Redis
+is fakeredis when installed, otherwise REDIS_URL; without either, rate limiting
+falls back to unthrottled as in production.
+
+If the baseline file exists, results are compared to it and the exit status is
+1 when a case regressed by more than --tolerance. --save-baseline overwrites it.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Settings read at import time by config: set before any service module is imported
+os.environ.setdefault('GA4_PROPERTY_ID', 'benchmark')
+# reset_collections() drops the whole database, so an exported MONGO_DB is never used
+os.environ['MONGO_DB'] = os.getenv('BENCHMARK_MONGO_DB', 'ga_benchmark')
+if 'benchmark' not in os.environ['MONGO_DB']:
+    sys.exit(f"BENCHMARK_MONGO_DB must name a benchmark database (containing 'benchmark'), "
+             f"got {os.environ['MONGO_DB']!r}")
+os.environ.setdefault('GA_CACHE_ENABLED', '0')
+os.environ.setdefault('GA_QUOTA_BACKOFF_BASE', '0.05')
+
+# name -> (higher is better?) for the compared fields
+_COMPARED = {'rows_per_s': True, 'p50_ms': False, 'p99_ms': False, 'peak_mb': False, 'bytes_per_row': False}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(latencies, rows, peak_bytes):
+    total = sum(latencies)
+    return {
+        'calls': len(latencies),
+        'rows': rows,
+        'rows_per_s': round(rows / total, 1) if total else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_mb': round(peak_bytes / 1e6, 2),
+    }
+
+
+def measure(fn, repeat):
+    """Call fn() repeat times; returns (latencies, results, tracemalloc peak over all calls)."""
+    latencies, results = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results.append(fn())
+            latencies.append(time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return latencies, results, peak
+
+
+def setup_mongo(mongo_uri):
+    from db import mongo
+    if mongo_uri:
+        os.environ['MONGO_URI'] = mongo_uri
+        mongo.MONGO_URI = mongo_uri
+        mongo.init_mongo()
+        return 'mongod'
+    import mongomock
+    mongo._client = mongomock.MongoClient()
+    mongo._db = mongo._client[mongo.MONGO_DB]
+    mongo._pid = os.getpid()
+    return 'mongomock'
+
+
+def setup_redis():
+    try:
+        import fakeredis
+    except ImportError:
+        return os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    from services.queue import setup, coalesce
+    from services.ga4 import cache, ratelimit, telemetry
+    conn = fakeredis.FakeRedis()
+    for module in (setup, coalesce, cache, ratelimit, telemetry):
+        module.redis_conn = conn
+    return 'fakeredis'
+
+
+def reset_collections():
+    from db.mongo import get_db
+    from services.ga4.loader import ensure_indexes
+    db = get_db()
+    if 'benchmark' not in db.name:
+        raise RuntimeError(f'refusing to drop the collections of {db.name}, not a benchmark database')
+    for name in db.list_collection_names():
+        db[name].drop()
+    ensure_indexes(db)
+
+
+def bench_process_response(sizes, repeat):
+    from config import COMBINED_DIMENSIONS, COMBINED_METRICS
+    from services.ga4.processor import process_response
+    from benchmarks.fake_ga import make_response
+    results = {}
+    for rows in sizes:
+        response = make_response(COMBINED_DIMENSIONS, COMBINED_METRICS, rows)
+        latencies, _, peak = measure(lambda: process_response(response), repeat)
+        results[f'process_response_{rows}'] = summarize(latencies, rows * repeat, peak)
+    return results
+
+
+def bench_save_rows(rows, repeat):
+    """Bulk writes of SAVE_CHUNK_SIZE rows: new rows, then unchanged rows, then changed metrics."""
+    from config import COMBINED_DIMENSIONS, COMBINED_METRICS, SAVE_CHUNK_SIZE
+    from services.ga4.processor import process_response
+    from services.ga4.loader import save_rows_to_collection
+    from benchmarks.fake_ga import make_response
+    data = process_response(make_response(COMBINED_DIMENSIONS, COMBINED_METRICS, rows))
+    chunks = [data[i:i + SAVE_CHUNK_SIZE] for i in range(0, len(data), SAVE_CHUNK_SIZE)]
+    results = {}
+    for scenario in ('insert', 'unchanged', 'modified'):
+        latencies, peak, total = [], 0, 0
+        for n in range(repeat):
+            if scenario == 'insert':
+                reset_collections()
+            for chunk in chunks:
+                if scenario == 'modified':
+                    chunk = [dict(r, sessions=r['sessions'] + n + 1) for r in chunk]
+                else:
+                    chunk = [dict(r) for r in chunk]
+                chunk_latencies, _, chunk_peak = measure(lambda: save_rows_to_collection('combined_dimensions', chunk), 1)
+                latencies += chunk_latencies
+                peak = max(peak, chunk_peak)
+                total += len(chunk)
+        results[f'save_rows_{scenario}'] = summarize(latencies, total, peak)
+    return results
+
+
+def _stored_bytes(db, name):
+    """(data bytes, index bytes) of a collection: collStats on mongod; on mongomock the BSON size of its documents and no index size."""
+    try:
+        stats = db.command('collStats', name)
+        return stats['size'], stats['totalIndexSize']
+    except Exception:
+        import bson
+        return sum(len(bson.encode(doc)) for doc in db[name].find()), None
+
+
+def bench_storage(rows, days, repeat):
+    """
+    The documents and buckets layouts of combined_dimensions (COMBINED_STORAGE)
+    side by side: writing `days` days of rows, the bytes stored per row, and
+    reading the whole range and a one-country slice of it through the /ga/data reader.
+    """
+    from config import COMBINED_DIMENSIONS, COMBINED_METRICS
+    from db.mongo import get_db
+    from services.ga4 import buckets
+    from services.ga4.loader import save_rows_in_chunks
+    from services.ga4.processor import process_response
+    from services.ga4.reader import DataQuery
+    from benchmarks.fake_ga import make_response
+    dates = [f'2024-02-{d:02d}' for d in range(1, days + 1)]
+    # cardinality 10 spreads the rows over several streams (the last dimension)
+    data = process_response(make_response(COMBINED_DIMENSIONS, COMBINED_METRICS, rows, cardinality=10))
+    queries = {'range': {}, 'filtered': {'country': ['country_0']}}
+    layout_before = buckets.COMBINED_STORAGE
+    results = {}
+    try:
+        for layout in ('documents', 'buckets'):
+            buckets.COMBINED_STORAGE = layout
+            reset_collections()
+            latencies, peak = [], 0
+            for date_str in dates:
+                day = [dict(r, date=date_str, property_id='benchmark') for r in data]
+                day_latencies, _, day_peak = measure(lambda: save_rows_in_chunks('combined_dimensions', day), 1)
+                latencies += day_latencies
+                peak = max(peak, day_peak)
+            stored = len(data) * len(dates)
+            collection = buckets.COMBINED_BUCKET_COLLECTION if layout == 'buckets' else 'combined_dimensions'
+            data_bytes, index_bytes = _stored_bytes(get_db(), collection)
+            results[f'storage_{layout}_write'] = dict(
+                summarize(latencies, stored, peak), bytes_per_row=round(data_bytes / stored, 1),
+                index_bytes_per_row=round(index_bytes / stored, 1) if index_bytes is not None else None)
+            for name, filters in queries.items():
+                query = DataQuery('combined_dimensions', dates[0], dates[-1], filters=filters)
+                latencies, returned, peak = measure(lambda: list(query.rows(0)), repeat)
+                results[f'storage_{layout}_{name}_read'] = summarize(latencies, sum(map(len, returned)), peak)
+    finally:
+        buckets.COMBINED_STORAGE = layout_before
+    return results
+
+
+def bench_run_ga(fake, name, repeat, **kwargs):
+    """Full run_ga runs on empty collections; the first (unmeasured) run generates the fake reports."""
+    from services.ga4.runner import run_ga
+    from benchmarks.fake_ga import install
+    undo = install(fake)
+    try:
+        reset_collections()
+        run_ga(**kwargs)
+        fake.stats.update(calls=0, quota_errors=0)
+        latencies, results, peak = [], [], 0
+        for _ in range(repeat):
+            reset_collections()
+            run_latencies, run_results, run_peak = measure(lambda: run_ga(**kwargs), 1)
+            latencies += run_latencies
+            results += run_results
+            peak = max(peak, run_peak)
+    finally:
+        undo()
+    rows = sum(_rows_of(r) for r in results)
+    summary = summarize(latencies, rows, peak)
+    summary['ga_calls'] = fake.stats['calls']
+    summary['quota_errors'] = fake.stats['quota_errors']
+    return {name: summary}
+
+
+def _rows_of(result):
+    if 'rows_count' in result:
+        return result['rows_count']
+    return sum(sum(entry['inserted'].values()) for entry in result.get('mapped', {}).values())
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing each case's change against the baseline, and whether any regressed."""
+    lines, regressed = [], False
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            lines.append(f'  {name:32} new case')
+            continue
+        changes = []
+        for field, higher_is_better in _COMPARED.items():
+            old, new = before.get(field), current.get(field)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag, regressed = ' REGRESSION', True
+            changes.append(f'{field} {change:+.0%}{flag}')
+        lines.append(f'  {name:32} ' + ', '.join(changes))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='smaller sizes and fewer repeats')
+    parser.add_argument('--mongo-uri', help='use this mongod instead of the in-process mongomock')
+    parser.add_argument('--baseline', default=os.path.join(ROOT, 'benchmarks', 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='write these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression per field')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake GA latency per call (seconds)')
+    args = parser.parse_args()
+
+    from services.ga4.client import GA_INSTALLED
+    if not GA_INSTALLED:
+        sys.exit('google-analytics-data is required (for the report message types)')
+    meta = {'python': platform.python_version(), 'machine': platform.machine(),
+            'mongo': setup_mongo(args.mongo_uri), 'redis': setup_redis(), 'quick': args.quick,
+            'fake_ga_latency_s': args.latency}
+
+    from benchmarks.fake_ga import FakeGAClient
+    repeat = 2 if args.quick else 5
+    days = 3 if args.quick else 7
+    # mongomock upserts scan the collection, so it only gets write volumes it can finish
+    if args.mongo_uri:
+        rows = 2000 if args.quick else 10000
+    else:
+        rows = 100 if args.quick else 300
+    results = {}
+    results.update(bench_process_response([1000, 10000] if args.quick else [1000, 10000, 100000], repeat))
+    results.update(bench_save_rows(rows, 2 if args.quick else 3))
+    results.update(bench_storage(rows, days, repeat))
+    dated = {'mode': 'combined', 'start_date': '2024-01-01', 'end_date': f'2024-01-{days:02d}'}
+    results.update(bench_run_ga(FakeGAClient(rows_per_report=rows, latency=args.latency),
+                                'run_ga_combined', repeat, **dated))
+    results.update(bench_run_ga(FakeGAClient(rows_per_report=rows, latency=args.latency, quota_error_rate=0.25),
+                                'run_ga_combined_quota_errors', repeat, **dated))
+    # mapped reports have one dimension, so cardinality bounds their row count
+    results.update(bench_run_ga(FakeGAClient(rows_per_report=rows, cardinality=rows, latency=args.latency),
+                                'run_ga_mapped', repeat, mode='mapped'))
+
+    print(json.dumps(meta))
+    print(f'  {"case":32} {"rows/s":>12} {"p50 ms":>10} {"p99 ms":>10} {"peak MB":>9}')
+    for name, r in results.items():
+        print(f'  {name:32} {r["rows_per_s"]:>12} {r["p50_ms"]:>10} {r["p99_ms"]:>10} {r["peak_mb"]:>9}')
+    print(f'  {"stored per row":32} {"data B":>12} {"index B":>10}')
+    for name, r in results.items():
+        if 'bytes_per_row' in r:
+            print(f'  {name:32} {r["bytes_per_row"]:>12} {str(r["index_bytes_per_row"]):>10}')
+
+    regressed = False
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        recorded = baseline.get('meta', {})
+        if (recorded.get('quick'), recorded.get('mongo')) != (args.quick, meta['mongo']):
+            print('baseline was recorded with a different --quick or Mongo setting; not compared')
+        else:
+            print(f'against {args.baseline}:')
+            lines, regressed = compare(results, baseline.get('results', {}), args.tolerance)
+            print('\n'.join(lines))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'baseline saved to {args.baseline}')
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
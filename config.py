@@ -7,9 +7,11 @@ MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/ga4_service_db')
 MONGO_DB = os.getenv('MONGO_DB', 'ga4_service_db')
 GA_JOBS = os.getenv('GA_JOBS', 'ga_jobs')
 
-# GA4 property and client secrets
+# GA4 property and client secrets. GA4_PROPERTY_ID is the default property of a run;
+# GA_PROPERTY_IDS (comma separated), if set, lists every property /ga/run accepts
 CLIENT_SECRETS_FILE = os.getenv('CLIENT_SECRETS_FILE')
 GA4_PROPERTY_ID = os.getenv('GA4_PROPERTY_ID')
+GA_PROPERTY_IDS = [p.strip() for p in os.getenv('GA_PROPERTY_IDS', '').split(',') if p.strip()]
 
 # Combined report (as found in original repo)
 COMBINED_DIMENSIONS = ['country', 'deviceCategory', 'landingPagePlusQueryString', 'streamId']
@@ -25,10 +27,130 @@ DIMENSION_METRIC_MAP = {
     'itemName': ['itemsViewed','itemsAddedToCart','itemsPurchased','itemRevenue']
 }
 
-# Unique keys for collections (used to upsert)
+# Unique keys for collections (used to upsert): the property, the date and the dimension values.
+# Each gets a compound unique index from services.ga4.loader.ensure_indexes()
 DIMENSION_UNIQUE_KEYS = {
-    'combined_dimensions': ['id']
+    'combined_dimensions': ['property_id', 'date'] + COMBINED_DIMENSIONS,
+    **{f'ga_{dim}': ['property_id', dim] for dim in DIMENSION_METRIC_MAP}
 }
 
 # App behavior
 MAX_METRICS_PER_REQUEST = 9
+# Reports per batch_run_reports call (API maximum is 5)
+GA_BATCH_SIZE = 5
+
+# Max number of dates fetched from GA in parallel for combined date ranges
+GA_FETCH_CONCURRENCY = int(os.getenv('GA_FETCH_CONCURRENCY', '4'))
+
+# By default RQ forks a fresh work horse per job, isolating jobs from each other.
+# Set to 1 to run jobs in the worker process itself (SimpleWorker) so the GA client
+# stays warm across jobs; a crash, leak or global state of one job then affects the next
+RQ_SIMPLE_WORKER = os.getenv('RQ_SIMPLE_WORKER', '0') == '1'
+
+# Rows requested per GA runReport page (API maximum is 250000)
+GA_PAGE_SIZE = int(os.getenv('GA_PAGE_SIZE', '100000'))
+
+# Rows per Mongo bulk write when saving streamed report rows
+SAVE_CHUNK_SIZE = int(os.getenv('SAVE_CHUNK_SIZE', '5000'))
+
+# How combined date ranges are fetched: 'per_day' (one request per date) or
+# 'range' (one request per slice of GA_RANGE_SLICE_DAYS, with 'date' as a dimension)
+COMBINED_FETCH_STRATEGY = os.getenv('COMBINED_FETCH_STRATEGY', 'per_day')
+GA_RANGE_SLICE_DAYS = int(os.getenv('GA_RANGE_SLICE_DAYS', '31'))
+# A slice reporting more rows than this is re-fetched one date at a time
+GA_RANGE_MAX_ROWS = int(os.getenv('GA_RANGE_MAX_ROWS', '250000'))
+
+# GA report response cache (Redis). Reports ending more than GA_PROCESSING_DAYS ago
+# are final and kept until evicted; newer ones expire after GA_CACHE_RECENT_TTL seconds
+GA_CACHE_ENABLED = os.getenv('GA_CACHE_ENABLED', '1') == '1'
+GA_CACHE_RECENT_TTL = int(os.getenv('GA_CACHE_RECENT_TTL', '3600'))
+GA_CACHE_MAX_ENTRIES = int(os.getenv('GA_CACHE_MAX_ENTRIES', '10000'))
+# least recently used responses are evicted beyond this many serialized bytes in total
+GA_CACHE_MAX_BYTES = int(os.getenv('GA_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+GA_PROCESSING_DAYS = int(os.getenv('GA_PROCESSING_DAYS', '3'))
+
+# Incremental sync: high-water marks live in SYNC_STATE_COLLECTION. Each run re-checks
+# INCREMENTAL_LOOKBACK_DAYS before the mark for late data; a first run fetches
+# INCREMENTAL_INITIAL_DAYS days
+SYNC_STATE_COLLECTION = os.getenv('SYNC_STATE_COLLECTION', 'ga_sync_state')
+INCREMENTAL_LOOKBACK_DAYS = int(os.getenv('INCREMENTAL_LOOKBACK_DAYS', '2'))
+INCREMENTAL_INITIAL_DAYS = int(os.getenv('INCREMENTAL_INITIAL_DAYS', '30'))
+
+# /ga/run splits combined ranges longer than this many days into chunk jobs
+FANOUT_CHUNK_DAYS = int(os.getenv('FANOUT_CHUNK_DAYS', '7'))
+
+# Capacity, in rows, of each queue between the fetch, process and write pipeline
+# stages; when full, upstream stages block (backpressure). A single page larger
+# than this still passes through an empty queue
+PIPELINE_QUEUE_ROWS = int(os.getenv('PIPELINE_QUEUE_ROWS', '50000'))
+
+# GA request scheduling per property, shared by all workers through Redis. The rate
+# (requests/second) adapts between the min and max from the returned property quota
+GA_RATE_MAX_RPS = float(os.getenv('GA_RATE_MAX_RPS', '10'))
+GA_RATE_MIN_RPS = float(os.getenv('GA_RATE_MIN_RPS', '0.2'))
+GA_RATE_BURST = int(os.getenv('GA_RATE_BURST', '5'))
+# GA4 standard properties allow 10 concurrent requests
+GA_MAX_CONCURRENT_REQUESTS = int(os.getenv('GA_MAX_CONCURRENT_REQUESTS', '10'))
+# Slow down once less than this fraction of hourly/daily tokens remains
+GA_QUOTA_LOW_FRACTION = float(os.getenv('GA_QUOTA_LOW_FRACTION', '0.2'))
+GA_QUOTA_MAX_RETRIES = int(os.getenv('GA_QUOTA_MAX_RETRIES', '5'))
+GA_QUOTA_BACKOFF_BASE = float(os.getenv('GA_QUOTA_BACKOFF_BASE', '2'))
+
+# Resuming a job (/ga/resume) re-runs only dates without a 'done' checkpoint;
+# a date is given up on after this many resumes
+RESUME_MAX_ATTEMPTS = int(os.getenv('RESUME_MAX_ATTEMPTS', '3'))
+
+# /ga/run points duplicate requests at the in-flight job and trims overlapping
+# combined ranges to the dates no in-flight job covers. Entries expire after
+# COALESCE_TTL seconds in case a job never reports back
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', '1') == '1'
+COALESCE_TTL = int(os.getenv('COALESCE_TTL', '7200'))
+
+# Per-stage timings (GA requests, conversion, Mongo writes) for job results and /metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+
+# Day/week/month rollups of combined_dimensions, updated with $inc deltas on every save
+# (services.ga4.rollups). ROLLUP_DIMENSIONS lists the dimension subsets to roll up:
+# subsets separated by ';', dimensions by ','; 'total' is the subset with no dimensions
+ROLLUP_ENABLED = os.getenv('ROLLUP_ENABLED', '1') == '1'
+ROLLUP_DIMENSIONS = [
+    [] if subset.strip() == 'total' else [d.strip() for d in subset.split(',') if d.strip()]
+    for subset in os.getenv('ROLLUP_DIMENSIONS', 'total;country;deviceCategory;streamId;country,deviceCategory').split(';')
+    if subset.strip()
+]
+# Ratio metrics and the metric that weights them when rows are summed into a rollup
+ROLLUP_WEIGHTED_METRICS = {
+    'bounceRate': 'sessions',
+    'engagementRate': 'sessions',
+    'averageSessionDuration': 'sessions',
+    'organicGoogleSearchClickThroughRate': 'organicGoogleSearchImpressions',
+    'organicGoogleSearchAveragePosition': 'organicGoogleSearchImpressions',
+}
+
+# GET /ga/data: rows per page (default and maximum) and pages kept in each API
+# process's LRU cache. The loader bumps a per-date data version in
+# DATA_VERSIONS_COLLECTION on every write; ETags and cache entries are derived from it
+DATA_PAGE_SIZE = int(os.getenv('DATA_PAGE_SIZE', '1000'))
+DATA_MAX_PAGE_SIZE = int(os.getenv('DATA_MAX_PAGE_SIZE', '10000'))
+DATA_CACHE_SIZE = int(os.getenv('DATA_CACHE_SIZE', '256'))
+DATA_VERSIONS_COLLECTION = os.getenv('DATA_VERSIONS_COLLECTION', 'ga_data_versions')
+
+# Fair scheduling of runs across properties on the shared worker pool
+# (services.queue.scheduler): each property has at most GA_PROPERTY_MAX_ACTIVE_JOBS
+# jobs queued or running, and waiting jobs are admitted round-robin between properties.
+# A job not reported finished within GA_SCHEDULER_STALE_SECONDS no longer counts
+GA_FAIR_SCHEDULING = os.getenv('GA_FAIR_SCHEDULING', '1') == '1'
+GA_PROPERTY_MAX_ACTIVE_JOBS = int(os.getenv('GA_PROPERTY_MAX_ACTIVE_JOBS', '2'))
+GA_SCHEDULER_STALE_SECONDS = int(os.getenv('GA_SCHEDULER_STALE_SECONDS', '3600'))
+
+# Storage layout of combined_dimensions: 'documents' (one document per row) or
+# 'buckets' (services.ga4.buckets: documents per property, day and stream in
+# COMBINED_BUCKET_COLLECTION, with positional row values). Switch an existing
+# database with `python -m services.ga4.buckets --convert`
+COMBINED_STORAGE = os.getenv('COMBINED_STORAGE', 'documents')
+COMBINED_BUCKET_COLLECTION = os.getenv('COMBINED_BUCKET_COLLECTION', 'combined_dimensions_buckets')
+# A day of one stream that outgrows a bucket continues in overflow buckets; a bucket
+# takes new rows up to this many rows or (approximate BSON) bytes, well under Mongo's
+# 16 MB document limit
+COMBINED_BUCKET_MAX_ROWS = int(os.getenv('COMBINED_BUCKET_MAX_ROWS', '20000'))
+COMBINED_BUCKET_MAX_BYTES = int(os.getenv('COMBINED_BUCKET_MAX_BYTES', str(8 * 1024 * 1024)))
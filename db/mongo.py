@@ -2,26 +2,42 @@ from pymongo import MongoClient
 from config import MONGO_URI, MONGO_DB
 from pymongo.errors import ConnectionFailure
 import os
+import threading
 
 _client = None
 _db = None
+# process that opened _client; MongoClient is not fork-safe, so a forked child opens its own
+_pid = None
+_lock = threading.Lock()
 
-def init_mongo():
-    global _client, _db
-    if _client:
-        return
+def _connect():
+    global _client, _db, _pid
     uri = MONGO_URI
     if not uri:
         raise RuntimeError('MONGO_URI not set in environment')
     _client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+    _db = _client[MONGO_DB]
+    _pid = os.getpid()
+
+def init_mongo():
+    """Connect and ping, to fail fast at startup if Mongo is misconfigured or down."""
+    if _client and _pid == os.getpid():
+        return
+    _connect()
     try:
         # trigger connection
         _client.admin.command('ping')
     except ConnectionFailure as e:
         raise RuntimeError(f'Could not connect to MongoDB: {e}')
-    _db = _client[MONGO_DB]
 
 def get_db():
-    if _db is None:
-        raise RuntimeError('Mongo not initialized. Call init_mongo() first.')
+    """
+    The database for this process. Connects on first use (MongoClient connects
+    lazily, so this costs no round trip) and again after a fork, so modules can
+    be imported, and workers forked, before any connection is opened.
+    """
+    if _db is None or _pid != os.getpid():
+        with _lock:
+            if _db is None or _pid != os.getpid():
+                _connect()
     return _db
@@ -0,0 +1,231 @@
+# buckets: compact storage of combined_dimensions, documents per property, day and stream
+#
+# With COMBINED_STORAGE=buckets the loader writes combined_dimensions rows into
+# COMBINED_BUCKET_COLLECTION instead of one document per row, e.g.
+#   {p: '123', d: '2024-01-01', s: '456', n: 0,
+#    f: ['country', 'deviceCategory', 'landingPagePlusQueryString', 'bounceRate', ...],
+#    r: {'3f9c2a71d0b4e8a6': ['US', 'mobile', '/', 0.41, ...], ...},
+#    k: <rows in r>, z: <approximate bytes of r>, c: <created>, u: <updated>}
+# Field names are stored once per bucket (f) instead of once per row, rows are
+# value lists in that order, and a row carries no timestamps or content hash:
+# an unchanged row is found by comparing its values. Rows are keyed in r by a
+# hash of their dimension values, so re-syncing a row is one $set in its
+# bucket's upsert. find_rows() expands buckets back into ordinary rows; the
+# reader (services.ga4.reader) and rollups read through it.
+#
+# A document must stay under Mongo's 16 MB limit, so a day of one stream is a
+# sequence of buckets n = 0, 1, ...: new rows go into the last one until it holds
+# COMBINED_BUCKET_MAX_ROWS rows or COMBINED_BUCKET_MAX_BYTES, then the next one
+# is started. A stored row stays in the bucket it was first written to.
+import hashlib
+import json
+import bson
+from datetime import datetime
+from db.mongo import get_db
+from config import (COMBINED_DIMENSIONS, COMBINED_METRICS, COMBINED_STORAGE, COMBINED_BUCKET_COLLECTION,
+                    COMBINED_BUCKET_MAX_ROWS, COMBINED_BUCKET_MAX_BYTES, DIMENSION_UNIQUE_KEYS, SAVE_CHUNK_SIZE)
+from pymongo import UpdateOne, ASCENDING
+
+SOURCE_COLLECTION = 'combined_dimensions'
+# the natural-key fields every bucket is keyed on, and their codes in bucket documents
+BUCKET_FIELDS = {'property_id': 'p', 'date': 'd', 'streamId': 's'}
+ROW_DIMENSIONS = [d for d in COMBINED_DIMENSIONS if d not in BUCKET_FIELDS]
+ROW_FIELDS = ROW_DIMENSIONS + COMBINED_METRICS
+
+
+def enabled_for(collection_name):
+    return COMBINED_STORAGE == 'buckets' and collection_name == SOURCE_COLLECTION
+
+
+def row_key(row):
+    """Key of a row within its bucket: a hash of its dimension values outside the bucket key."""
+    return hashlib.sha1(json.dumps([row.get(d) for d in ROW_DIMENSIONS]).encode()).hexdigest()[:16]
+
+
+def _bucket_key(row):
+    return tuple(row.get(f) for f in BUCKET_FIELDS)
+
+
+def _bucket_filter(key):
+    return dict(zip(BUCKET_FIELDS.values(), key))
+
+
+def _stored_key(bucket):
+    return tuple(bucket.get(code) for code in BUCKET_FIELDS.values())
+
+
+def _size(k, values):
+    """Approximate BSON size of one row entry of r."""
+    return len(bson.encode({k: values}))
+
+
+def _row(key, fields, values):
+    row = dict(zip(BUCKET_FIELDS, key))
+    row.update(zip(fields, values))
+    return row
+
+
+def _reencode(col, bucket_id):
+    """Rewrite a bucket stored with an older field list (f) in the current ROW_FIELDS order."""
+    bucket = col.find_one({'_id': bucket_id})
+    rows = {k: dict(zip(bucket['f'], values)) for k, values in bucket.get('r', {}).items()}
+    bucket['r'] = {k: [row.get(f) for f in ROW_FIELDS] for k, row in rows.items()}
+    bucket['f'] = ROW_FIELDS
+    col.replace_one({'_id': bucket['_id']}, bucket)
+    return bucket
+
+
+def write_rows(rows, db=None):
+    """
+    Save combined_dimensions rows into their buckets with one upsert per bucket written.
+    Returns (outcomes, changes): 'inserted', 'modified' or 'skipped' per row, in
+    order, and the (row, previous stored version or None) pairs of the written rows.
+    A row repeated within rows is written once, from its last occurrence.
+    """
+    db = db if db is not None else get_db()
+    col = db[COMBINED_BUCKET_COLLECTION]
+    by_key = {}
+    for i, r in enumerate(rows):
+        by_key.setdefault(_bucket_key(r), {})[row_key(r)] = (i, r)
+    if not by_key:
+        return [], []
+
+    # only the rows about to be written are read back, not whole buckets; a row
+    # may be in any bucket of its day and stream
+    projection = {code: 1 for code in BUCKET_FIELDS.values()}
+    projection.update({'n': 1, 'f': 1, 'k': 1, 'z': 1})
+    projection.update({f'r.{k}': 1 for entries in by_key.values() for k in entries})
+    stored = {}
+    for bucket in col.find({'$or': [_bucket_filter(key) for key in by_key]}, projection):
+        if bucket.get('f') != ROW_FIELDS:
+            bucket = _reencode(col, bucket['_id'])
+        stored.setdefault(_stored_key(bucket), []).append(bucket)
+
+    now = datetime.utcnow()
+    outcomes = ['skipped'] * len(rows)
+    changes = []
+    ops = []
+    for key, entries in by_key.items():
+        sequence = sorted(stored.get(key, []), key=lambda b: b.get('n', 0))
+        holders = {k: b for b in sequence for k in b.get('r', {})}
+        last = sequence[-1] if sequence else {}
+        # the bucket that takes new rows, and how full it is
+        n, n_rows, n_bytes = last.get('n', 0), last.get('k', 0), last.get('z', 0)
+        updates = {}
+        for k, (i, r) in entries.items():
+            values = [r.get(f) for f in ROW_FIELDS]
+            holder = holders.get(k)
+            previous = holder['r'][k] if holder else None
+            if previous == values:
+                continue
+            size = _size(k, values)
+            if holder:
+                target, added, grown = holder.get('n', 0), 0, size - _size(k, previous)
+            else:
+                if n_rows and (n_rows >= COMBINED_BUCKET_MAX_ROWS or n_bytes + size > COMBINED_BUCKET_MAX_BYTES):
+                    n, n_rows, n_bytes = n + 1, 0, 0
+                n_rows, n_bytes = n_rows + 1, n_bytes + size
+                target, added, grown = n, 1, size
+            outcomes[i] = 'inserted' if previous is None else 'modified'
+            changes.append((r, None if previous is None else _row(key, ROW_FIELDS, previous)))
+            update = updates.setdefault(target, {'set': {}, 'k': 0, 'z': 0})
+            update['set'][f'r.{k}'] = values
+            update['k'] += added
+            update['z'] += grown
+        for target, update in updates.items():
+            ops.append(UpdateOne({**_bucket_filter(key), 'n': target},
+                                 {'$set': {'f': ROW_FIELDS, 'u': now, **update['set']},
+                                  '$inc': {'k': update['k'], 'z': update['z']},
+                                  '$setOnInsert': {'c': now}}, upsert=True))
+    if ops:
+        col.bulk_write(ops, ordered=False)
+    return outcomes, changes
+
+
+def sort_key(row):
+    """A row's natural key for sorting; nulls sort first, as in the unique index of the documents layout."""
+    return tuple('' if row.get(k) is None else row.get(k) for k in DIMENSION_UNIQUE_KEYS[SOURCE_COLLECTION])
+
+
+def find_rows(query=None, db=None, ordered=False):
+    """
+    Rows of the buckets matching query, a filter on the bucket fields (p, d, s).
+    ordered=True yields them in natural-key order (property, date, then the row's
+    dimensions and stream), holding one property's day of buckets at a time.
+    """
+    db = db if db is not None else get_db()
+    cursor = db[COMBINED_BUCKET_COLLECTION].find(query or {}, {'_id': 0, 'c': 0, 'u': 0, 'k': 0, 'z': 0})
+    if not ordered:
+        for bucket in cursor:
+            key = _stored_key(bucket)
+            for values in bucket.get('r', {}).values():
+                yield _row(key, bucket['f'], values)
+        return
+    day, rows = None, []
+    for bucket in cursor.sort([(code, ASCENDING) for code in BUCKET_FIELDS.values()] + [('n', ASCENDING)]):
+        key = _stored_key(bucket)
+        if key[:2] != day:
+            yield from sorted(rows, key=sort_key)
+            day, rows = key[:2], []
+        rows.extend(_row(key, bucket['f'], values) for values in bucket.get('r', {}).values())
+    yield from sorted(rows, key=sort_key)
+
+
+def date_bounds(db=None):
+    """(first, last) stored date, or None when there are no dated buckets."""
+    db = db if db is not None else get_db()
+    col = db[COMBINED_BUCKET_COLLECTION]
+    first = col.find_one({'d': {'$ne': None}}, {'d': 1}, sort=[('d', ASCENDING)])
+    last = col.find_one({'d': {'$ne': None}}, {'d': 1}, sort=[('d', -1)])
+    return (first['d'], last['d']) if first else None
+
+
+def ensure_bucket_indexes(db=None):
+    db = db if db is not None else get_db()
+    col = db[COMBINED_BUCKET_COLLECTION]
+    keys = [(code, ASCENDING) for code in BUCKET_FIELDS.values()] + [('n', ASCENDING)]
+    name = f'{COMBINED_BUCKET_COLLECTION}_natural_key'
+    existing = col.index_information().get(name)
+    if existing and existing['key'] != keys:
+        # buckets written before overflow buckets: each is the first of its sequence
+        col.drop_index(name)
+        for bucket in col.find({'n': {'$exists': False}}, {'r': 1}):
+            rows = bucket.get('r', {})
+            col.update_one({'_id': bucket['_id']}, {'$set': {
+                'n': 0, 'k': len(rows), 'z': sum(_size(k, values) for k, values in rows.items())}})
+    col.create_index(keys, unique=True, name=name)
+
+
+def convert(db=None, chunk_size=SAVE_CHUNK_SIZE):
+    """
+    Copy every combined_dimensions document into buckets, e.g. before switching
+    COMBINED_STORAGE to 'buckets'. The documents are left in place. Returns the
+    number of rows copied.
+    """
+    db = db if db is not None else get_db()
+    ensure_bucket_indexes(db)
+    keys = list(BUCKET_FIELDS) + ROW_DIMENSIONS
+    projection = {'_id': 0, **{f: 1 for f in keys + COMBINED_METRICS}}
+    count = 0
+    chunk = []
+    for doc in db[SOURCE_COLLECTION].find({}, projection).sort([(k, ASCENDING) for k in keys]):
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            write_rows(chunk, db)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        write_rows(chunk, db)
+        count += len(chunk)
+    return count
+
+
+if __name__ == '__main__':
+    # Switch layouts: python -m services.ga4.buckets --convert
+    import logging
+    import sys
+    from db.mongo import init_mongo
+    if sys.argv[1:] != ['--convert']:
+        sys.exit('usage: python -m services.ga4.buckets --convert')
+    init_mongo()
+    logging.warning(f'copied {convert()} rows into {COMBINED_BUCKET_COLLECTION}')
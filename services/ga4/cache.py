@@ -0,0 +1,146 @@
+# cache: Redis-backed cache of GA report responses, keyed by request fingerprint
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, date
+from config import (GA_CACHE_ENABLED, GA_CACHE_RECENT_TTL, GA_CACHE_MAX_ENTRIES, GA_CACHE_MAX_BYTES,
+                    GA_PROCESSING_DAYS)
+from services.queue.setup import redis_conn
+from services.ga4.client import ga_types, GA_INSTALLED as _HAS_GA
+
+_KEY_PREFIX = 'ga_cache:'
+# sorted set of cached keys scored by last access, used for LRU eviction
+_INDEX_KEY = 'ga_cache_index'
+# hash of cached key -> response bytes, and their running total
+_SIZES_KEY = 'ga_cache_sizes'
+_BYTES_KEY = 'ga_cache_bytes'
+# sorted set of cached keys with a TTL, scored by expiry time
+_EXPIRY_KEY = 'ga_cache_expiry'
+_INDEX_KEYS = (_INDEX_KEY, _SIZES_KEY, _EXPIRY_KEY, _BYTES_KEY)
+
+# KEYS[1..4] the index keys above. Drops the bookkeeping of cached key ARGV[1]
+# (its value is already gone or about to be replaced)
+_FORGET = """
+local function forget(key)
+  local size = redis.call('HGET', KEYS[2], key)
+  if size then redis.call('DECRBY', KEYS[4], size) end
+  redis.call('HDEL', KEYS[2], key)
+  redis.call('ZREM', KEYS[1], key)
+  redis.call('ZREM', KEYS[3], key)
+end
+"""
+_FORGET_SCRIPT = _FORGET + "forget(ARGV[1])"
+
+# Records cached key ARGV[1] of ARGV[2] bytes, used at ARGV[3] and expiring at ARGV[4]
+# (0: never), after pruning entries whose TTL has run out. Then deletes least recently
+# used entries until at most ARGV[5] entries of at most ARGV[6] bytes are left, and
+# returns how many it deleted.
+_STORE_SCRIPT = _FORGET + """
+local now = tonumber(ARGV[3])
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)) do forget(key) end
+forget(ARGV[1])
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('INCRBY', KEYS[4], ARGV[2])
+if tonumber(ARGV[4]) > 0 then redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1]) end
+local evicted = 0
+while redis.call('ZCARD', KEYS[1]) > tonumber(ARGV[5]) or tonumber(redis.call('GET', KEYS[4])) > tonumber(ARGV[6]) do
+  local oldest = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+  if oldest == ARGV[1] then break end
+  forget(oldest)
+  redis.call('DEL', oldest)
+  evicted = evicted + 1
+end
+return evicted
+"""
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evicted': 0, 'errors': 0}
+
+
+def request_fingerprint(property_id, dimensions, metrics, start_date, end_date, **extra):
+    """Stable hash of everything that determines a report's content."""
+    payload = {
+        'property': str(property_id),
+        'dimensions': list(dimensions),
+        'metrics': list(metrics),
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+    payload.update({k: v for k, v in extra.items() if v})
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def ttl_for(end_date):
+    """
+    Seconds a report ending on end_date may be cached, or None to keep it until evicted.
+    Dates older than GA_PROCESSING_DAYS are final in GA; recent or relative dates
+    ('today', '7daysAgo') can still change, so they get GA_CACHE_RECENT_TTL.
+    """
+    try:
+        end = datetime.strptime(end_date, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return GA_CACHE_RECENT_TTL
+    if (date.today() - end).days > GA_PROCESSING_DAYS:
+        return None
+    return GA_CACHE_RECENT_TTL
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def get(fingerprint):
+    """Return the cached RunReportResponse for fingerprint, or None on a miss."""
+    if not (GA_CACHE_ENABLED and _HAS_GA):
+        return None
+    key = _KEY_PREFIX + fingerprint
+    try:
+        raw = redis_conn.get(key)
+        if raw is None:
+            redis_conn.eval(_FORGET_SCRIPT, len(_INDEX_KEYS), *_INDEX_KEYS, key)
+            _count('misses')
+            return None
+        redis_conn.zadd(_INDEX_KEY, {key: time.time()})
+        _count('hits')
+        return ga_types().RunReportResponse.deserialize(raw)
+    except Exception as e:
+        # A broken cache must never break a sync; treat it as a miss
+        logging.warning(f"GA cache read failed: {e}")
+        _count('errors')
+        return None
+
+
+def put(fingerprint, response, end_date):
+    """
+    Store response under fingerprint and evict least recently used entries beyond
+    GA_CACHE_MAX_ENTRIES or GA_CACHE_MAX_BYTES. A response larger than the byte
+    budget on its own is not cached.
+    """
+    if not (GA_CACHE_ENABLED and _HAS_GA):
+        return
+    key = _KEY_PREFIX + fingerprint
+    try:
+        raw = ga_types().RunReportResponse.serialize(response)
+        if len(raw) > GA_CACHE_MAX_BYTES:
+            return
+        ttl = ttl_for(end_date)
+        now = time.time()
+        redis_conn.set(key, raw, ex=ttl)
+        evicted = redis_conn.eval(_STORE_SCRIPT, len(_INDEX_KEYS), *_INDEX_KEYS, key, len(raw), now,
+                                  now + ttl if ttl else 0, GA_CACHE_MAX_ENTRIES, GA_CACHE_MAX_BYTES)
+        _count('stores')
+        if evicted:
+            _count('evicted', evicted)
+    except Exception as e:
+        logging.warning(f"GA cache write failed: {e}")
+        _count('errors')
+
+
+def get_cache_stats():
+    """Hit/miss/store/eviction counters for this process."""
+    with _lock:
+        return dict(_stats)
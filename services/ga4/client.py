@@ -0,0 +1,118 @@
+# client: process-wide GA4 Data API client, shared by threads and RQ jobs
+import importlib
+import importlib.util
+import os
+import threading
+import logging
+from config import CLIENT_SECRETS_FILE
+
+
+def _installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# The GA library pulls in protobuf, gRPC and google-auth, which is slow to import.
+# Only check that it is installed here; it is imported on first use (ga_types(),
+# api_exceptions(), get_client()), so the API and forked job processes that never
+# talk to GA don't pay for it.
+GA_INSTALLED = _installed('google.analytics.data_v1beta')
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_creds_mtime = None
+_stats = {'created': 0, 'reused': 0, 'reset': 0}
+
+
+def ga_types():
+    """google.analytics.data_v1beta.types (request/response messages), imported on first use."""
+    return importlib.import_module('google.analytics.data_v1beta.types')
+
+
+def api_exceptions():
+    """google.api_core.exceptions, imported on first use; None if the GA library is missing."""
+    if not GA_INSTALLED:
+        return None
+    return importlib.import_module('google.api_core.exceptions')
+
+
+def _channel_errors():
+    # errors that usually mean the channel (not the request) is broken
+    gexc = api_exceptions()
+    return (gexc.ServiceUnavailable, gexc.Unauthenticated) if gexc else ()
+
+
+def _secrets_mtime():
+    try:
+        return os.path.getmtime(CLIENT_SECRETS_FILE)
+    except (TypeError, OSError):
+        return None
+
+
+def _close(client):
+    try:
+        client.transport.close()
+    except Exception:
+        pass
+
+
+def get_client():
+    """
+    Return the warm client for this process, building it on first use.
+    The client is rebuilt after a fork (gRPC channels can't cross processes)
+    or when the service-account file changes on disk (credential rotation).
+    """
+    global _client, _client_pid, _creds_mtime
+    if not GA_INSTALLED:
+        raise RuntimeError('google-analytics-data library not available')
+    mtime = _secrets_mtime()
+    with _lock:
+        if _client is not None and _client_pid == os.getpid() and _creds_mtime == mtime:
+            _stats['reused'] += 1
+            return _client
+        if _client is not None and _client_pid == os.getpid():
+            # rotated credentials: close the old channel; one inherited across a fork
+            # belongs to the parent process and is only dropped
+            _close(_client)
+            _stats['reset'] += 1
+        from google.oauth2 import service_account
+        from google.analytics.data_v1beta import BetaAnalyticsDataClient
+        creds = service_account.Credentials.from_service_account_file(CLIENT_SECRETS_FILE)
+        _client = BetaAnalyticsDataClient(credentials=creds)
+        _client_pid = os.getpid()
+        _creds_mtime = mtime
+        _stats['created'] += 1
+        logging.info(f"GA4 client created (pid={_client_pid}, total created={_stats['created']})")
+        return _client
+
+
+def reset_client():
+    """Drop the cached client so the next get_client() builds a fresh channel."""
+    global _client
+    with _lock:
+        if _client is not None:
+            _close(_client)
+            _client = None
+            _stats['reset'] += 1
+
+
+def call_with_client(fn):
+    """
+    Call fn(client). If it fails with a channel-level error, rebuild the
+    client once and retry; any other error propagates unchanged.
+    """
+    try:
+        return fn(get_client())
+    except _channel_errors() as e:
+        logging.warning(f"GA4 channel error, rebuilding client: {e}")
+        reset_client()
+        return fn(get_client())
+
+
+def get_client_stats():
+    """Counters for client creations, reuses and resets in this process."""
+    with _lock:
+        return dict(_stats, pid=os.getpid())
@@ -1,36 +1,301 @@
 from db.mongo import get_db
-from pymongo import UpdateOne
+from config import SAVE_CHUNK_SIZE, DIMENSION_UNIQUE_KEYS, COMBINED_METRICS, DATA_VERSIONS_COLLECTION
+from services.ga4 import telemetry, rollups, buckets
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import OperationFailure, BulkWriteError
 from datetime import datetime
+import hashlib
+import json
+import logging
+import time
 import uuid
 
+# Fields that change on every run without the GA data changing; left out of the content hash
+_VOLATILE_FIELDS = ('_id', 'id', 'created_at', 'updated_at', '_content_hash')
+
 def _build_filter_for_row(collection_name, row, unique_keys_map):
     if collection_name not in unique_keys_map:
         return None
-    keys = unique_keys_map[collection_name]
-    f = {}
-    for k in keys:
-        if k in row:
-            f[k] = row[k]
-        else:
-            return None
+    # A missing key field (e.g. 'date' on an undated run) is keyed as null, like the unique index does
+    f = {k: row.get(k) for k in unique_keys_map[collection_name]}
     return f if f else None
 
-def save_rows_to_collection(collection_name, rows):
+def ensure_indexes(db=None):
+    """
+    Create the compound unique index behind each collection's natural key.
+    Meant to run once at startup (app/worker) or via `python -m services.ga4.loader`,
+    not per batch. Returns the collections whose index could not be built, which
+    means they still hold duplicates from before natural keys (see remove_duplicates).
+    An index built for an older natural key (e.g. before property_id) is replaced.
+    """
+    db = db if db is not None else get_db()
+    failed = []
+    for collection_name, keys in DIMENSION_UNIQUE_KEYS.items():
+        name = f'{collection_name}_natural_key'
+        try:
+            current = db[collection_name].index_information().get(name)
+            if current and [k for k, _ in current['key']] != keys:
+                db[collection_name].drop_index(name)
+            db[collection_name].create_index([(k, ASCENDING) for k in keys], unique=True, name=name)
+        except OperationFailure as e:
+            logging.error(f"Unique index on {collection_name} not created ({e}); "
+                          f"run `python -m services.ga4.loader --dedupe` to remove duplicates")
+            failed.append(collection_name)
+    if rollups.enabled_for(rollups.SOURCE_COLLECTION):
+        rollups.ensure_rollup_indexes(db)
+    if buckets.enabled_for(buckets.SOURCE_COLLECTION):
+        buckets.ensure_bucket_indexes(db)
+    return failed
+
+def remove_duplicates(collection_name, db=None):
+    """Keep the most recently updated row per natural key and delete the rest. Returns the number deleted."""
+    db = db if db is not None else get_db()
+    col = db[collection_name]
+    keys = DIMENSION_UNIQUE_KEYS[collection_name]
+    pipeline = [
+        {'$sort': {'updated_at': -1}},
+        {'$group': {'_id': {k: f'${k}' for k in keys}, 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+        {'$match': {'n': {'$gt': 1}}},
+    ]
+    deleted = 0
+    for group in col.aggregate(pipeline, allowDiskUse=True):
+        stale = group['ids'][1:]
+        col.delete_many({'_id': {'$in': stale}})
+        deleted += len(stale)
+    return deleted
+
+def assign_property(collection_name, property_id, db=None):
+    """
+    Stamp rows saved before property_id joined the natural key with property_id.
+    A row whose stamped twin a newer run already wrote is deleted instead.
+    Returns (assigned, deleted).
+    """
+    db = db if db is not None else get_db()
+    col = db[collection_name]
+    assigned = deleted = 0
+    ids = [doc['_id'] for doc in col.find({'property_id': None}, {'_id': 1})]
+    for i in range(0, len(ids), SAVE_CHUNK_SIZE):
+        chunk = ids[i:i + SAVE_CHUNK_SIZE]
+        try:
+            res = col.bulk_write([UpdateOne({'_id': _id}, {'$set': {'property_id': property_id}}) for _id in chunk],
+                                 ordered=False)
+            assigned += res.modified_count
+        except BulkWriteError as e:
+            assigned += e.details.get('nModified', 0)
+            # 11000: duplicate key, the property's row already exists
+            twins = [chunk[err['index']] for err in e.details.get('writeErrors', []) if err.get('code') == 11000]
+            if len(twins) < len(e.details.get('writeErrors', [])):
+                raise
+            deleted += col.delete_many({'_id': {'$in': twins}}).deleted_count
+    return assigned, deleted
+
+def content_hash(row):
+    """Hash of a row's dimension and metric values, ignoring bookkeeping fields."""
+    data = {k: v for k, v in row.items() if k not in _VOLATILE_FIELDS}
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+# Leading fields of every natural key; _existing_docs looks rows up per combination of them
+_GROUP_KEYS = ('property_id', 'date')
+
+def _existing_docs(col, keys, filters, fields=()):
+    """
+    Map natural-key tuple -> stored _content_hash and `fields` of the rows about to be written.
+    One clause per property and date, with $in on the key dimension with the most distinct
+    values, instead of a clause per row; the keys are then matched here.
+    """
+    if not filters:
+        return {}
+    group_keys = [k for k in keys if k in _GROUP_KEYS]
+    other_keys = [k for k in keys if k not in _GROUP_KEYS]
+    groups = {}
+    for f in filters:
+        groups.setdefault(tuple(f[k] for k in group_keys), []).append(f)
+    clauses = []
+    for group, group_filters in groups.items():
+        clause = dict(zip(group_keys, group))
+        if other_keys:
+            values = {k: list(dict.fromkeys(f[k] for f in group_filters)) for k in other_keys}
+            dim = max(other_keys, key=lambda k: len(values[k]))
+            clause[dim] = {'$in': values[dim]}
+        clauses.append(clause)
+
+    wanted = {tuple(f[k] for k in keys) for f in filters}
+    existing = {}
+    projection = {k: 1 for k in keys}
+    projection['_content_hash'] = 1
+    projection.update({f: 1 for f in fields})
+    for doc in col.find(clauses[0] if len(clauses) == 1 else {'$or': clauses}, projection):
+        key = tuple(doc.get(k) for k in keys)
+        if key in wanted:
+            existing[key] = doc
+    return existing
+
+def version_id(collection_name, date_str=None):
+    """_id of a data version document: one per collection ('*') and one per date of a dated collection."""
+    return f'{collection_name}:{date_str or "*"}'
+
+def bump_versions(collection_name, dates, db=None):
+    """Mark collection_name (and each of dates) as changed, invalidating ETags and cached reads of it."""
+    db = db if db is not None else get_db()
+    now = datetime.utcnow()
+    ops = [UpdateOne({'_id': version_id(collection_name, d)}, {'$inc': {'version': 1}, '$set': {'updated_at': now}},
+                     upsert=True)
+           for d in [None] + sorted(d for d in dates if d)]
+    db[DATA_VERSIONS_COLLECTION].bulk_write(ops, ordered=False)
+
+def _write_rows(collection_name, rows):
+    """
+    Upsert rows on their natural key and return one outcome per row, in order:
+    'inserted', 'modified' or 'skipped'. Rows whose content hash matches the stored
+    one are skipped, so unchanged data costs a read instead of a write. A write
+    that changed anything bumps the data versions of the dates it touched.
+    Collections with rollups (services.ga4.rollups) also read the stored metrics,
+    and the rollups move by the difference once the rows are written.
+    With COMBINED_STORAGE=buckets, combined_dimensions rows go to their
+    day's buckets instead (services.ga4.buckets).
+    """
     db = get_db()
-    db['combined_dimensions'].create_index('date')
+    if buckets.enabled_for(collection_name):
+        try:
+            outcomes, changes = buckets.write_rows(rows, db)
+        except BulkWriteError:
+            # buckets written before the error would be skipped as unchanged next time
+            if rollups.enabled_for(collection_name):
+                rollups.mark_stale({r.get('date') for r in rows}, db)
+            raise
+        if changes:
+            bump_versions(collection_name, {r.get('date') for r, _ in changes}, db)
+            if rollups.enabled_for(collection_name):
+                rollups.apply_changes(changes, db)
+        return outcomes
     col = db[collection_name]
-    ops = []
+    keys = DIMENSION_UNIQUE_KEYS.get(collection_name, [])
+    with_rollups = rollups.enabled_for(collection_name)
+    prepared = []
     for r in rows:
         r = dict(r)
-        r['updated_at'] = datetime.utcnow()
-        filt = _build_filter_for_row(collection_name, r, {'combined_dimensions':['id']})
+        prepared.append((r, _build_filter_for_row(collection_name, r, DIMENSION_UNIQUE_KEYS)))
+    existing = _existing_docs(col, keys, [filt for _, filt in prepared if filt],
+                              fields=COMBINED_METRICS if with_rollups else ())
+
+    ops = []
+    outcomes = []
+    op_rows = []  # row index of each op, to map bulk results back onto rows
+    changes = []  # (row, stored version or None) of each written row, for the rollups
+    for i, (r, filt) in enumerate(prepared):
         if filt:
-            ops.append(UpdateOne(filt, {'$set': r}, upsert=True))
+            r['_content_hash'] = content_hash(r)
+            stored = existing.get(tuple(filt[k] for k in keys))
+            if stored and stored.get('_content_hash') == r['_content_hash']:
+                outcomes.append('skipped')
+                continue
+            outcomes.append('modified')
+            if with_rollups:
+                changes.append((r, stored))
+            r['updated_at'] = datetime.utcnow()
+            on_insert = {'created_at': r.pop('created_at')} if 'created_at' in r else {}
+            update = {'$set': r}
+            if on_insert:
+                update['$setOnInsert'] = on_insert
+            ops.append(UpdateOne(filt, update, upsert=True))
         else:
+            # random _id: only ever inserted, an existing match is left untouched
+            outcomes.append('skipped')
+            r['updated_at'] = datetime.utcnow()
             if '_id' not in r:
                 r['_id'] = str(uuid.uuid4())
             ops.append(UpdateOne({'_id': r['_id']}, {'$setOnInsert': r}, upsert=True))
-    if not ops:
-        return {'inserted': 0, 'modified': 0}
-    res = col.bulk_write(ops, ordered=False)
-    return {'inserted': res.upserted_count, 'modified': res.modified_count}
+        op_rows.append(i)
+    if ops:
+        try:
+            res = col.bulk_write(ops, ordered=False)
+        except BulkWriteError:
+            # rows written before the error would be skipped as unchanged next time
+            if changes:
+                rollups.mark_stale({r.get('date') for r, _ in changes}, db)
+            raise
+        for op_index in res.upserted_ids:
+            outcomes[op_rows[op_index]] = 'inserted'
+        if res.upserted_count or res.modified_count:
+            bump_versions(collection_name, {prepared[i][0].get('date') for i in op_rows}, db)
+    if changes:
+        rollups.apply_changes(changes, db)
+    return outcomes
+
+def save_rows_to_collection(collection_name, rows):
+    """Upsert rows on their natural key. Returns {'inserted', 'modified', 'skipped'}."""
+    counts = {'inserted': 0, 'modified': 0, 'skipped': 0}
+    rows = list(rows)
+    mode, group = telemetry.labels_for_collection(collection_name)
+    with telemetry.timed('mongo_write', mode, group, date=rows[0].get('date') if rows else None) as t:
+        outcomes = _write_rows(collection_name, rows)
+        t['rows'] = len(rows)
+    for outcome in outcomes:
+        counts[outcome] += 1
+    return counts
+
+def save_rows_by_group(collection_name, rows, field):
+    """
+    Save rows from several groups (e.g. dates) in one bulk write and return
+    {group value: {'inserted', 'modified', 'skipped'}} keyed by row[field].
+    """
+    by_group = {}
+    start = time.perf_counter()
+    for r, outcome in zip(rows, _write_rows(collection_name, rows)):
+        counts = by_group.setdefault(r.get(field), {'inserted': 0, 'modified': 0, 'skipped': 0})
+        counts[outcome] += 1
+    # one bulk write, timed once and shared between the groups by row count
+    elapsed = time.perf_counter() - start
+    mode, group = telemetry.labels_for_collection(collection_name)
+    for value, counts in by_group.items():
+        n = sum(counts.values())
+        telemetry.observe('mongo_write', elapsed * n / len(rows), mode, group, rows=n,
+                          date=value if field == 'date' else None)
+    return by_group
+
+def save_rows_in_chunks(collection_name, rows, chunk_size=SAVE_CHUNK_SIZE, sample_size=2):
+    """
+    Consume any iterable of rows and save it in bulk writes of chunk_size rows,
+    so only one chunk is held in memory at a time.
+    Returns (inserted, rows_count, sample) where sample holds the first sample_size rows.
+    """
+    totals = {'inserted': 0, 'modified': 0, 'skipped': 0}
+    count = 0
+    sample = []
+    chunk = []
+    for r in rows:
+        count += 1
+        if len(sample) < sample_size:
+            sample.append(r)
+        chunk.append(r)
+        if len(chunk) >= chunk_size:
+            add_counts(totals, save_rows_to_collection(collection_name, chunk))
+            chunk = []
+    if chunk:
+        add_counts(totals, save_rows_to_collection(collection_name, chunk))
+    return totals, count, sample
+
+def add_counts(totals, res):
+    """Add one save result's inserted/modified/skipped counts into totals (in place)."""
+    for k, v in res.items():
+        totals[k] = totals.get(k, 0) + v
+    return totals
+
+
+if __name__ == '__main__':
+    # One-time migrations: python -m services.ga4.loader [--dedupe] [--assign-property PROPERTY_ID]
+    import sys
+    from db.mongo import init_mongo
+    init_mongo()
+    if '--dedupe' in sys.argv:
+        for name in DIMENSION_UNIQUE_KEYS:
+            logging.warning(f"{name}: removed {remove_duplicates(name)} duplicate rows")
+    failed = ensure_indexes()
+    if '--assign-property' in sys.argv:
+        property_id = sys.argv[sys.argv.index('--assign-property') + 1]
+        for name in DIMENSION_UNIQUE_KEYS:
+            assigned, deleted = assign_property(name, property_id)
+            logging.warning(f"{name}: {assigned} rows assigned to property {property_id}, {deleted} superseded rows removed")
+        if rollups.enabled_for(rollups.SOURCE_COLLECTION):
+            logging.warning(f"rebuilt {rollups.rebuild_all()} rollup documents")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,283 @@
+# pipeline: fetch -> process -> write stages joined by bounded queues
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import GA_FETCH_CONCURRENCY, PIPELINE_QUEUE_ROWS, SAVE_CHUNK_SIZE
+from services.ga4.processor import iter_response_rows
+from services.ga4.loader import save_rows_by_group, add_counts
+from services.ga4 import telemetry
+
+_DONE = object()
+# follows a date's last page through the stages; marks the date as fully fetched
+_DATE_DONE = object()
+# how often blocked stages re-check whether another stage has failed
+_POLL_SECONDS = 0.5
+
+
+class _Aborted(Exception):
+    """Raised inside a stage when another stage failed and the pipeline is shutting down."""
+
+
+class DateIncomplete(Exception):
+    """
+    Raised by fetch_date when only part of a date's rows could be fetched: the rows
+    emitted are written, the message becomes the date's warning, and the date is
+    never reported to on_date_done, so it stays unfinished.
+    """
+
+
+class _Stage:
+    """Per-stage counters: items handled, time busy, and time blocked on either queue."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+
+    def add(self, field, value):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + value)
+
+    def as_dict(self):
+        return {'items': self.items, 'busy_s': round(self.busy, 3),
+                'wait_input_s': round(self.wait_in, 3), 'wait_output_s': round(self.wait_out, 3)}
+
+
+def _row_count(item):
+    """Rows held by a queue item: a report page, a simulated or converted row list, or a marker (0)."""
+    if isinstance(item, list):
+        return len(item)
+    return len(item.rows) if hasattr(item, 'rows') else 0
+
+
+class _Queue:
+    """
+    Queue bounded by the rows its items hold rather than by their number, since a
+    page can be anything from a few rows to GA_PAGE_SIZE. It records its peak row
+    count and gives up once the pipeline is aborted. An item larger than the whole
+    budget is still accepted by an empty queue, so one big page cannot stall it.
+    """
+
+    def __init__(self, max_rows, abort):
+        self.max_rows = max_rows
+        self.abort = abort
+        self.items = collections.deque()
+        self.rows = 0
+        self.max_depth = 0
+        self.cond = threading.Condition()
+
+    def put_waiting(self, item, stage, rows=0):
+        # A full queue blocks the producer: this is the backpressure
+        start = time.perf_counter()
+        with self.cond:
+            while True:
+                if self.abort.is_set():
+                    raise _Aborted()
+                if not self.items or self.rows + rows <= self.max_rows:
+                    break
+                self.cond.wait(_POLL_SECONDS)
+            self.items.append((item, rows))
+            self.rows += rows
+            self.max_depth = max(self.max_depth, self.rows)
+            self.cond.notify_all()
+        stage.add('wait_out', time.perf_counter() - start)
+
+    def get_waiting(self, stage):
+        start = time.perf_counter()
+        with self.cond:
+            while True:
+                if self.abort.is_set():
+                    raise _Aborted()
+                if self.items:
+                    break
+                self.cond.wait(_POLL_SECONDS)
+            item, rows = self.items.popleft()
+            self.rows -= rows
+            self.cond.notify_all()
+        stage.add('wait_in', time.perf_counter() - start)
+        return item
+
+
+def run_pipeline(collection_name, dates, fetch_date, stats=None, concurrency=GA_FETCH_CONCURRENCY,
+                 queue_rows=PIPELINE_QUEUE_ROWS, batch_size=SAVE_CHUNK_SIZE, sample_size=2, on_date_done=None,
+                 fields=None):
+    """
+    Sync dates through three overlapping stages:
+      - fetch: up to `concurrency` threads call fetch_date(date_str, emit), which emits
+        raw report pages (RunReportResponse or a simulated list of rows) and returns a
+        warning string or None, or raises DateIncomplete after a partial fetch;
+      - process: converts pages to dict rows and stamps each row with its date
+        and any `fields` (e.g. {'property_id': ...});
+      - write: groups rows from any number of dates into bulk writes of batch_size rows.
+    The queues between stages hold at most queue_rows rows each, so slow Mongo
+    writes stall the fetchers instead of piling pages up in memory.
+
+    Returns [(date_str, inserted, rows_count, sample, warning), ...] in date order.
+    If stats is a dict, per-stage and per-queue counters are merged into it.
+    on_date_done(date_str, inserted, rows_count, warning), if given, is called from the
+    writer as soon as every row of a date has been written (e.g. to checkpoint it).
+    An exception in any stage stops the others and is re-raised here; an exception
+    in the calling thread (e.g. RQ's job timeout) stops every stage before it propagates.
+    """
+    mode, group = telemetry.labels_for_collection(collection_name)
+    abort = threading.Event()
+    fetched = _Queue(queue_rows, abort)
+    processed = _Queue(queue_rows, abort)
+    stages = {name: _Stage(name) for name in ('fetch', 'process', 'write')}
+    per_date = {d: {'inserted': {'inserted': 0, 'modified': 0, 'skipped': 0}, 'rows_count': 0,
+                    'sample': [], 'warning': None} for d in dates}
+    errors = []
+
+    def fetch_one(date_str):
+        stage = stages['fetch']
+
+        def emit(page):
+            fetched.put_waiting((date_str, page), stage, _row_count(page))
+            stage.add('items', 1)
+
+        start = time.perf_counter()
+        try:
+            per_date[date_str]['warning'] = fetch_date(date_str, emit)
+        except DateIncomplete as e:
+            per_date[date_str]['warning'] = str(e)
+            return
+        finally:
+            stage.add('busy', time.perf_counter() - start)
+        fetched.put_waiting((date_str, _DATE_DONE), stage)
+
+    def fetch_all():
+        try:
+            workers = max(1, min(concurrency, len(dates)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ga-fetch') as pool:
+                futures = [pool.submit(fetch_one, d) for d in dates]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    # dates not started yet are dropped; running ones finish
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except _Aborted:
+            return
+        except Exception as e:
+            errors.append(e)
+        # Even after a failed fetch, the later stages drain what was already fetched,
+        # so every fully fetched date is still written (and reported to on_date_done)
+        try:
+            fetched.put_waiting(_DONE, stages['fetch'])
+        except _Aborted:
+            pass
+
+    def process():
+        stage = stages['process']
+        try:
+            while True:
+                item = fetched.get_waiting(stage)
+                if item is _DONE:
+                    processed.put_waiting(_DONE, stage)
+                    return
+                date_str, page = item
+                if page is _DATE_DONE:
+                    processed.put_waiting(item, stage)
+                    continue
+                start = time.perf_counter()
+                rows = []
+                for r in iter_response_rows(page):
+                    # Add the date field to every row (important: we don't add 'date' as GA dimension)
+                    r['date'] = date_str
+                    if fields:
+                        r.update(fields)
+                    rows.append(r)
+                elapsed = time.perf_counter() - start
+                stage.add('busy', elapsed)
+                stage.add('items', 1)
+                telemetry.observe('convert', elapsed, mode, group, rows=len(rows), date=date_str)
+                processed.put_waiting((date_str, rows), stage, len(rows))
+        except _Aborted:
+            pass
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+
+    def write():
+        stage = stages['write']
+        batch = []
+        batch_dates = set()
+        # dates fully fetched whose last rows are still in the unwritten batch
+        awaiting_flush = []
+
+        def date_done(date_str):
+            if on_date_done:
+                entry = per_date[date_str]
+                on_date_done(date_str, entry['inserted'], entry['rows_count'], entry['warning'])
+
+        def flush():
+            start = time.perf_counter()
+            for date_str, counts in save_rows_by_group(collection_name, batch, 'date').items():
+                add_counts(per_date[date_str]['inserted'], counts)
+            stage.add('busy', time.perf_counter() - start)
+            stage.add('items', 1)
+            batch.clear()
+            batch_dates.clear()
+            for date_str in awaiting_flush:
+                date_done(date_str)
+            awaiting_flush.clear()
+
+        try:
+            while True:
+                item = processed.get_waiting(stage)
+                if item is _DONE:
+                    break
+                date_str, rows = item
+                if rows is _DATE_DONE:
+                    if date_str in batch_dates:
+                        awaiting_flush.append(date_str)
+                    else:
+                        date_done(date_str)
+                    continue
+                batch_dates.add(date_str)
+                for r in rows:
+                    entry = per_date[r['date']]
+                    entry['rows_count'] += 1
+                    if len(entry['sample']) < sample_size:
+                        entry['sample'].append(r)
+                    batch.append(r)
+                    if len(batch) >= batch_size:
+                        flush()
+            if batch:
+                flush()
+        except _Aborted:
+            pass
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+
+    threads = [threading.Thread(target=fn, name=f'ga-{fn.__name__}', daemon=True)
+               for fn in (fetch_all, process, write)]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    except BaseException:
+        # the job was interrupted here (timeout, shutdown): no stage may keep
+        # writing rows or checkpoints for it
+        abort.set()
+        raise
+    if errors:
+        raise errors[0]
+
+    if stats is not None:
+        for name, stage in stages.items():
+            add_counts(stats.setdefault('stages', {}).setdefault(name, {}), stage.as_dict())
+        for name, q in (('fetched', fetched), ('processed', processed)):
+            entry = stats.setdefault('queues', {}).setdefault(name, {'capacity_rows': q.max_rows, 'max_depth': 0})
+            entry['max_depth'] = max(entry['max_depth'], q.max_depth)
+
+    return [(d, per_date[d]['inserted'], per_date[d]['rows_count'], per_date[d]['sample'], per_date[d]['warning'])
+            for d in dates]
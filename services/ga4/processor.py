@@ -1,30 +1,93 @@
 # processor: converts GA run_report response into list of dict rows
-try:
-    from google.analytics.data_v1beta.types import RunReportResponse, Row
-    _HAS_GA = True
-except Exception:
-    _HAS_GA = False
+from services.ga4 import telemetry
 
-def process_response(response):
-    """Convert a RunReportResponse (real GA client) into list of dict rows.
-    If a simulated object (list) is passed, it's returned unchanged.
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        # GA occasionally sends integer metrics as "12.0"; anything else stays raw
+        return _to_float(value)
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+# MetricType name -> (fast builtin parser, tolerant fallback). Currency, seconds and
+# the other unit types are decimals; unknown types get float(), as every metric did before.
+_PARSERS = {
+    'TYPE_INTEGER': (int, _to_int),
+}
+_DEFAULT_PARSERS = (float, _to_float)
+
+def _metric_type_name(header):
+    type_ = getattr(header, 'type_', None)
+    return getattr(type_, 'name', type_)
+
+def metric_parsers(response, tolerant=True):
+    """One parser per metric column, chosen once per response from metric_headers[].type_.
+    tolerant=False returns the bare builtins, which raise ValueError on a bad cell.
     """
-    # If response already a list (simulation), return directly
-    if isinstance(response, list):
+    pick = 1 if tolerant else 0
+    return [_PARSERS.get(_metric_type_name(h), _DEFAULT_PARSERS)[pick] for h in response.metric_headers]
+
+def _raw_pb(response):
+    """The underlying protobuf of a proto-plus response. Walking raw protobuf rows
+    avoids proto-plus wrapping every row and cell on attribute access, which is
+    where most of the conversion time goes."""
+    try:
+        return type(response).pb(response)
+    except Exception:
         return response
+
+def response_size(response):
+    """Serialized size in bytes of a GA response (0 for simulated rows)."""
+    if response is None or isinstance(response, list):
+        return 0
+    try:
+        return _raw_pb(response).ByteSize()
+    except Exception:
+        return 0
+
+def iter_response_rows(response):
+    """Yield dict rows from a RunReportResponse (real GA client) one at a time.
+    If a simulated object (list) is passed, its rows are yielded unchanged.
+    """
     if response is None:
-        return []
-    rows = []
+        return
+    # If response already a list (simulation), yield directly
+    if isinstance(response, list):
+        yield from response
+        return
     dh = [h.name for h in response.dimension_headers]
     mh = [h.name for h in response.metric_headers]
-    for r in response.rows:
+    fast = metric_parsers(response, tolerant=False)
+    tolerant = metric_parsers(response)
+    for r in _raw_pb(response).rows:
         row = {}
         for i, dv in enumerate(r.dimension_values):
             row[dh[i]] = dv.value
-        for j, mv in enumerate(r.metric_values):
-            try:
-                row[mh[j]] = float(mv.value)
-            except:
-                row[mh[j]] = mv.value
-        rows.append(row)
+        try:
+            for j, mv in enumerate(r.metric_values):
+                row[mh[j]] = fast[j](mv.value)
+        except ValueError:
+            # rare non-numeric cell: redo this row's metrics with the per-cell fallbacks
+            for j, mv in enumerate(r.metric_values):
+                row[mh[j]] = tolerant[j](mv.value)
+        yield row
+
+def process_response(response):
+    """Convert a RunReportResponse (real GA client) into list of dict rows.
+    If a simulated object (list) is passed, it's returned unchanged.
+    """
+    if response is None:
+        return []
+    # If response already a list (simulation), return directly
+    if isinstance(response, list):
+        return response
+    mode, group = telemetry.labels_for_request([h.name for h in response.dimension_headers])
+    with telemetry.timed('convert', mode, group) as t:
+        rows = list(iter_response_rows(response))
+        t['rows'] = len(rows)
     return rows
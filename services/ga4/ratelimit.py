@@ -0,0 +1,207 @@
+# ratelimit: GA4 property-quota-aware request scheduling, shared by all workers via Redis
+import logging
+import random
+import threading
+import time
+import uuid
+from config import (GA_RATE_MAX_RPS, GA_RATE_MIN_RPS, GA_RATE_BURST, GA_MAX_CONCURRENT_REQUESTS,
+                    GA_QUOTA_LOW_FRACTION, GA_QUOTA_MAX_RETRIES, GA_QUOTA_BACKOFF_BASE)
+from services.queue.setup import redis_conn
+from services.ga4.client import api_exceptions
+
+# Token bucket refilled at the shared 'rate' (requests/second). Returns 0 when a token
+# was taken, otherwise the milliseconds to wait before trying again.
+_TOKEN_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate') or ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or burst)
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts') or now)
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = math.ceil((1 - tokens) / rate * 1000) end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+redis.call('HSET', KEYS[1], 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 86400)
+return wait
+"""
+
+# Counting semaphore over a sorted set of holders scored by lease expiry, so a
+# crashed worker's slot frees itself. Returns 1 when a slot was taken.
+_SLOT_SCRIPT = """
+local limit = tonumber(redis.call('HGET', KEYS[2], 'concurrency') or ARGV[1])
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < limit then
+  redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[3])
+  redis.call('EXPIRE', KEYS[1], 86400)
+  return 1
+end
+return 0
+"""
+
+# Moves the shared rate and concurrency in one step, so concurrent responses of all
+# workers each apply their adjustment. ARGV[1] 1 when tokens run low, ARGV[2] 1 when
+# GA reports almost no concurrent slots left; ARGV[3..5] max rate, min rate, max concurrency.
+_ADJUST_SCRIPT = """
+local max_rate, min_rate, max_concurrency = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate') or max_rate)
+local concurrency = tonumber(redis.call('HGET', KEYS[1], 'concurrency') or max_concurrency)
+if ARGV[1] == '1' then rate = math.max(min_rate, rate / 2) else rate = math.min(max_rate, rate * 1.1) end
+if ARGV[2] == '1' then
+  concurrency = math.max(1, concurrency - 1)
+else
+  concurrency = math.min(max_concurrency, concurrency + 1)
+end
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'concurrency', tostring(concurrency))
+return 1
+"""
+
+# longest a request may hold a concurrency slot before it is considered abandoned
+_SLOT_LEASE_SECONDS = 120
+
+_lock = threading.Lock()
+_stats = {'requests': 0, 'throttled': 0, 'wait_s': 0.0, 'quota_errors': 0, 'retries': 0}
+_redis_ok = True
+
+
+class QuotaExhausted(RuntimeError):
+    """GA kept rejecting requests for quota after every retry. Never replaced by simulated data."""
+
+
+def _quota_errors():
+    gexc = api_exceptions()
+    return (gexc.ResourceExhausted, gexc.TooManyRequests) if gexc else ()
+
+
+def _keys(property_id):
+    return f'ga_rate:{property_id}', f'ga_slots:{property_id}'
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def _redis_call(fn, default):
+    """Run a Redis operation; if Redis is unreachable, log once and run unthrottled."""
+    global _redis_ok
+    try:
+        result = fn()
+        _redis_ok = True
+        return result
+    except Exception as e:
+        if _redis_ok:
+            logging.warning(f"GA rate limiter unavailable, requests are not throttled: {e}")
+        _redis_ok = False
+        return default
+
+
+def _take_token(property_id):
+    bucket, _ = _keys(property_id)
+    return _redis_call(lambda: redis_conn.eval(_TOKEN_SCRIPT, 1, bucket, GA_RATE_MAX_RPS, GA_RATE_BURST, time.time()), 0)
+
+
+def _take_slot(property_id, holder):
+    bucket, slots = _keys(property_id)
+    return _redis_call(lambda: redis_conn.eval(_SLOT_SCRIPT, 2, slots, bucket, GA_MAX_CONCURRENT_REQUESTS,
+                                               time.time(), holder, _SLOT_LEASE_SECONDS), 1)
+
+
+def _release_slot(property_id, holder):
+    _, slots = _keys(property_id)
+    _redis_call(lambda: redis_conn.zrem(slots, holder), 0)
+
+
+def _acquire(property_id):
+    """Block until this process may send one request; returns the slot holder id."""
+    holder = str(uuid.uuid4())
+    start = time.perf_counter()
+    throttled = False
+    while True:
+        wait_ms = _take_token(property_id)
+        if not wait_ms:
+            break
+        throttled = True
+        time.sleep(wait_ms / 1000.0)
+    while not _take_slot(property_id, holder):
+        throttled = True
+        time.sleep(0.05 + random.random() * 0.1)
+    _count('requests')
+    if throttled:
+        _count('throttled')
+        _count('wait_s', time.perf_counter() - start)
+    return holder
+
+
+def _adjust(property_id, quota):
+    """
+    Move the shared rate and concurrency toward what the property quota allows:
+    halve the rate when hourly/daily tokens run below GA_QUOTA_LOW_FRACTION, otherwise
+    grow it by 10%; shrink concurrency when GA reports almost no concurrent slots left.
+    """
+    if not quota:
+        return
+    bucket, _ = _keys(property_id)
+
+    def low(status):
+        total = status.consumed + status.remaining
+        return total > 0 and status.remaining / total < GA_QUOTA_LOW_FRACTION
+
+    tokens_low = low(quota.tokens_per_hour) or low(quota.tokens_per_day)
+    slots_low = quota.concurrent_requests.remaining <= 1
+    _redis_call(lambda: redis_conn.eval(_ADJUST_SCRIPT, 1, bucket, int(tokens_low), int(slots_low),
+                                        GA_RATE_MAX_RPS, GA_RATE_MIN_RPS, GA_MAX_CONCURRENT_REQUESTS), None)
+
+
+class _Status:
+    def __init__(self, consumed, remaining):
+        self.consumed, self.remaining = consumed, remaining
+
+
+class _ExhaustedQuota:
+    """Stand-in property_quota used after a quota error: reads as fully consumed."""
+    tokens_per_hour = _Status(1, 0)
+    tokens_per_day = _Status(1, 0)
+    concurrent_requests = _Status(1, 0)
+
+
+def _quotas(response):
+    # run_report responses carry property_quota directly; batch responses per report
+    reports = getattr(response, 'reports', None)
+    if reports:
+        return [getattr(r, 'property_quota', None) for r in reports]
+    return [getattr(response, 'property_quota', None)]
+
+
+def throttled_call(property_id, fn):
+    """
+    Call fn() as one GA request for property_id: wait for the shared rate and
+    concurrency limits, feed the returned property_quota back into them, and retry
+    quota errors with exponential backoff. Raises QuotaExhausted after
+    GA_QUOTA_MAX_RETRIES so callers fail instead of writing simulated data.
+    """
+    for attempt in range(GA_QUOTA_MAX_RETRIES + 1):
+        holder = _acquire(property_id)
+        try:
+            response = fn()
+        except _quota_errors() as e:
+            _count('quota_errors')
+            # back off for everyone, not just this thread
+            _adjust(property_id, _ExhaustedQuota())
+            if attempt == GA_QUOTA_MAX_RETRIES:
+                raise QuotaExhausted(f'GA quota exhausted after {attempt + 1} attempts: {e}') from e
+            _count('retries')
+            time.sleep(GA_QUOTA_BACKOFF_BASE * (2 ** attempt) * (0.5 + random.random()))
+            continue
+        finally:
+            _release_slot(property_id, holder)
+        for quota in _quotas(response):
+            _adjust(property_id, quota)
+        return response
+
+
+def get_limiter_stats():
+    """Request, throttling and quota-error counters for this process."""
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,226 @@
+# reader: filtered, keyset-paginated reads of the synced collections (GET /ga/data)
+#
+# Rows are returned in natural-key order (DIMENSION_UNIQUE_KEYS), which is the
+# order of each collection's unique index, so a date range plus dimension filters
+# is an index range scan. A page ends with a cursor holding the last row's key;
+# the next page starts strictly after it instead of skipping rows.
+import base64
+import hashlib
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from db.mongo import get_db
+from config import (COMBINED_METRICS, DIMENSION_METRIC_MAP, DIMENSION_UNIQUE_KEYS, DATA_PAGE_SIZE,
+                    DATA_MAX_PAGE_SIZE, DATA_CACHE_SIZE, DATA_VERSIONS_COLLECTION)
+from services.ga4.loader import version_id
+from services.ga4 import buckets
+
+# Ranges up to this many days are versioned per date, so syncing new days leaves
+# the ETags of older ranges unchanged; longer or open ranges use the collection version
+_MAX_VERSIONED_DAYS = 400
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class QueryError(ValueError):
+    """The request names an unknown collection, field or filter, or a malformed value."""
+
+
+def collection_metrics(collection_name):
+    """Metric fields stored in a synced collection."""
+    if collection_name == 'combined_dimensions':
+        return COMBINED_METRICS
+    dim = collection_name[len('ga_'):]
+    if collection_name.startswith('ga_') and dim in DIMENSION_METRIC_MAP:
+        return DIMENSION_METRIC_MAP[dim]
+    raise QueryError(f'unknown collection {collection_name}')
+
+
+def _parse_date(value):
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise QueryError(f'dates must be YYYY-MM-DD, got {value!r}')
+    return value
+
+
+def encode_cursor(doc, keys):
+    return base64.urlsafe_b64encode(json.dumps([doc.get(k) for k in keys]).encode()).decode()
+
+
+def decode_cursor(cursor, keys):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise QueryError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise QueryError('invalid cursor')
+    return values
+
+
+def _after(keys, values):
+    """
+    Filter for rows whose key sorts strictly after values: (k1 > v1) or (k1 = v1 and k2 > v2) ...
+    Null sorts first, but {'$gt': None} matches nothing (comparisons stay within a
+    BSON type), so "after null" is written as not null.
+    """
+    branches = []
+    for i, key in enumerate(keys):
+        branch = {k: v for k, v in zip(keys[:i], values[:i])}
+        branch[key] = {'$ne': None} if values[i] is None else {'$gt': values[i]}
+        branches.append(branch)
+    return {'$or': branches}
+
+
+class DataQuery:
+    """
+    One validated read of a synced collection. filters maps dimension -> list of
+    accepted values; metrics limits the returned metrics (default all).
+    """
+
+    def __init__(self, collection_name, start_date=None, end_date=None, filters=None, metrics=None, cursor=None,
+                 limit=None):
+        self.collection_name = collection_name
+        self.keys = DIMENSION_UNIQUE_KEYS.get(collection_name)
+        available = collection_metrics(collection_name)
+        if (start_date or end_date) and 'date' not in self.keys:
+            raise QueryError(f'{collection_name} holds range totals without dates')
+        self.start_date = _parse_date(start_date) if start_date else None
+        self.end_date = _parse_date(end_date) if end_date else None
+        self.filters = filters or {}
+        unknown = [d for d in self.filters if d not in self.keys or d == 'date']
+        if unknown:
+            raise QueryError(f'cannot filter {collection_name} on {", ".join(unknown)}')
+        self.metrics = list(metrics) if metrics else list(available)
+        unknown = [m for m in self.metrics if m not in available]
+        if unknown:
+            raise QueryError(f'unknown metrics for {collection_name}: {", ".join(unknown)}')
+        self.cursor = cursor
+        self.after = decode_cursor(cursor, self.keys) if cursor else None
+        if limit is None:
+            self.limit = DATA_PAGE_SIZE
+        else:
+            try:
+                self.limit = int(limit)
+            except (TypeError, ValueError):
+                raise QueryError('limit must be an integer')
+            if not 0 < self.limit <= DATA_MAX_PAGE_SIZE:
+                raise QueryError(f'limit must be between 1 and {DATA_MAX_PAGE_SIZE}')
+
+    def _date_range(self):
+        date = {}
+        if self.start_date:
+            date['$gte'] = self.start_date
+        if self.end_date:
+            date['$lte'] = self.end_date
+        return date
+
+    def mongo_filter(self):
+        clauses = []
+        if self.start_date or self.end_date:
+            clauses.append({'date': self._date_range()})
+        for dim, values in sorted(self.filters.items()):
+            clauses.append({dim: values[0] if len(values) == 1 else {'$in': list(values)}})
+        if self.after is not None:
+            clauses.append(_after(self.keys, self.after))
+        if not clauses:
+            return {}
+        return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+    def describe(self):
+        """Everything that determines the result, in a stable order (for ETags and the cache)."""
+        return [self.collection_name, self.start_date, self.end_date,
+                sorted((d, sorted(v)) for d, v in self.filters.items()), self.metrics, self.cursor, self.limit]
+
+    def rows(self, limit=None, db=None):
+        """Matching rows in key order, streamed from a Mongo cursor; limit=0 means all of them."""
+        db = db if db is not None else get_db()
+        if buckets.enabled_for(self.collection_name):
+            rows = self._bucket_rows(db)
+            return itertools.islice(rows, limit) if limit else rows
+        projection = {'_id': 0, **{k: 1 for k in self.keys}, **{m: 1 for m in self.metrics}}
+        cursor = db[self.collection_name].find(self.mongo_filter(), projection)
+        cursor = cursor.sort([(k, 1) for k in self.keys]).batch_size(min(self.limit, 1000))
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def _bucket_rows(self, db):
+        """
+        Matching rows expanded from buckets (services.ga4.buckets), in key order. The
+        date, property and stream narrow the buckets in Mongo; the other filters and
+        the cursor apply to the expanded rows.
+        """
+        clauses = []
+        if self.start_date or self.end_date:
+            clauses.append({'d': self._date_range()})
+        for dim, code in buckets.BUCKET_FIELDS.items():
+            if dim in self.filters:
+                clauses.append({code: {'$in': list(self.filters[dim])}})
+        after = None
+        if self.after is not None:
+            # buckets of the cursor's own day may still hold later rows; null sorts
+            # first, as in _after, so after a null every value is later
+            p, d = self.after[0], self.after[1]
+            later = {'p': {'$ne': None}} if p is None else {'p': {'$gt': p}}
+            same = {'p': p} if d is None else {'p': p, 'd': {'$gte': d}}
+            clauses.append({'$or': [later, same]})
+            after = buckets.sort_key(dict(zip(self.keys, self.after)))
+        query = {'$and': clauses} if clauses else {}
+        fields = self.keys + self.metrics
+        for row in buckets.find_rows(query, db, ordered=True):
+            if after is not None and buckets.sort_key(row) <= after:
+                continue
+            if all(row.get(dim) in values for dim, values in self.filters.items()):
+                yield {f: row.get(f) for f in fields}
+
+    def page(self, db=None):
+        """{'rows', 'next_cursor'}: one page of self.limit rows; next_cursor is None on the last page."""
+        rows = list(self.rows(self.limit + 1, db))
+        more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        return {'rows': rows, 'next_cursor': encode_cursor(rows[-1], self.keys) if more else None}
+
+    def etag(self, db=None):
+        """
+        Strong ETag of this query's result: the query plus the data versions
+        (services.ga4.loader.bump_versions) of the dates it can return.
+        """
+        db = db if db is not None else get_db()
+        days = None
+        if self.start_date and self.end_date:
+            start = datetime.strptime(self.start_date, '%Y-%m-%d')
+            days = (datetime.strptime(self.end_date, '%Y-%m-%d') - start).days + 1
+        if days is not None and 0 < days <= _MAX_VERSIONED_DAYS:
+            ids = [version_id(self.collection_name, _day(start, i)) for i in range(days)]
+        else:
+            ids = [version_id(self.collection_name)]
+        versions = {d['_id']: d['version'] for d in db[DATA_VERSIONS_COLLECTION].find({'_id': {'$in': ids}})}
+        state = [self.describe(), [versions.get(i, 0) for i in ids]]
+        return hashlib.sha1(json.dumps(state, default=str).encode()).hexdigest()
+
+
+def _day(start, offset):
+    return (start + timedelta(days=offset)).strftime('%Y-%m-%d')
+
+
+def cached_page(etag):
+    """A page cached under etag by this process, or None."""
+    with _cache_lock:
+        page = _cache.get(etag)
+        if page is not None:
+            _cache.move_to_end(etag)
+        return page
+
+
+def cache_page(etag, page):
+    if DATA_CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        _cache[etag] = page
+        _cache.move_to_end(etag)
+        while len(_cache) > DATA_CACHE_SIZE:
+            _cache.popitem(last=False)
@@ -0,0 +1,286 @@
+# rollups: day/week/month totals of combined_dimensions, kept up to date on every save
+#
+# Each rollup document holds one period of one value combination of a dimension
+# subset (ROLLUP_DIMENSIONS) for one property, e.g.
+#   {group: 'country', period: 'week', start: '2024-01-01', property_id: '123', country: 'US',
+#    rows: 120, sessions: 5400, bounceRate_weighted: 2106.0, ...}
+# The loader passes every inserted or modified row with its previous stored
+# version, and the difference is applied with $inc, so a re-synced date moves
+# the totals by what changed instead of being counted twice. Ratio metrics
+# (ROLLUP_WEIGHTED_METRICS) are summed as metric * weight and divided by the
+# summed weight on read, so a week's bounceRate is weighted by each day's sessions.
+#
+# Deltas are only right against rollups that already hold the previous versions:
+# the first save with rollups enabled rebuilds them from the stored rows instead,
+# and a save whose rows or rollup update failed partway marks its dates stale, to
+# be rebuilt by rebuild_stale() (python -m services.ga4.rollups --stale).
+#
+# The ga_<dimension> collections hold undated range totals, so they have no
+# periods to roll up.
+import logging
+from datetime import datetime, timedelta
+from db.mongo import get_db
+from config import COMBINED_METRICS, ROLLUP_ENABLED, ROLLUP_DIMENSIONS, ROLLUP_WEIGHTED_METRICS
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import DuplicateKeyError
+from services.ga4 import buckets
+
+SOURCE_COLLECTION = 'combined_dimensions'
+ROLLUP_COLLECTION = 'combined_dimensions_rollups'
+# {'_id': 'built', 'done': bool}: the first full build; {'_id': 'stale', 'dates': [...]}
+ROLLUP_STATE_COLLECTION = 'combined_dimensions_rollups_state'
+PERIODS = ('day', 'week', 'month')
+
+# the property plus every dimension any subset uses: the unique index covers them all,
+# absent ones index as null
+_ROLLUP_KEYS = ['property_id'] + sorted({d for subset in ROLLUP_DIMENSIONS for d in subset})
+
+
+def group_name(dimensions):
+    """Name of a dimension subset as stored in rollup documents: 'country,deviceCategory', or 'total'."""
+    return ','.join(dimensions) or 'total'
+
+
+def enabled_for(collection_name):
+    return ROLLUP_ENABLED and collection_name == SOURCE_COLLECTION and bool(ROLLUP_DIMENSIONS)
+
+
+def period_start(date_str, period):
+    """First day (YYYY-MM-DD) of the day, ISO week (Monday) or month containing date_str."""
+    day = datetime.strptime(date_str, '%Y-%m-%d').date()
+    if period == 'week':
+        day -= timedelta(days=day.weekday())
+    elif period == 'month':
+        day = day.replace(day=1)
+    return day.strftime('%Y-%m-%d')
+
+
+def _period_end(date_str, period):
+    start = datetime.strptime(period_start(date_str, period), '%Y-%m-%d').date()
+    if period == 'week':
+        end = start + timedelta(days=6)
+    elif period == 'month':
+        end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    else:
+        end = start
+    return end.strftime('%Y-%m-%d')
+
+
+def contributions(row):
+    """What one row adds to the rollups it belongs to: its row count, metrics and weighted ratios."""
+    out = {'rows': 1}
+    for m in COMBINED_METRICS:
+        value = row.get(m) or 0
+        weight = ROLLUP_WEIGHTED_METRICS.get(m)
+        if weight:
+            out[f'{m}_weighted'] = value * (row.get(weight) or 0)
+        else:
+            out[m] = value
+    return out
+
+
+def _add_row(deltas, row, sign=1, periods=None):
+    """
+    Add sign * contributions(row) into deltas, keyed by (group, period, start,
+    dimension values). periods: optional {period: (first, last)} bounds on the start.
+    """
+    date_str = row.get('date')
+    if not date_str:
+        return
+    values = contributions(row)
+    starts = {p: period_start(date_str, p) for p in PERIODS}
+    for subset in ROLLUP_DIMENSIONS:
+        dims = tuple((d, row.get(d)) for d in ['property_id'] + subset)
+        for period, start in starts.items():
+            if periods and not periods[period][0] <= start <= periods[period][1]:
+                continue
+            totals = deltas.setdefault((group_name(subset), period, start, dims), {})
+            for field, value in values.items():
+                totals[field] = totals.get(field, 0) + sign * value
+
+
+def _write_deltas(deltas, db):
+    ops = []
+    for (group, period, start, dims), totals in deltas.items():
+        inc = {f: v for f, v in totals.items() if v}
+        if not inc:
+            continue
+        # equality on every indexed field (null where the subset has none), so Mongo
+        # retries an upsert that races another job's insert of the same document
+        filt = {'group': group, 'period': period, 'start': start, **dict.fromkeys(_ROLLUP_KEYS), **dict(dims)}
+        ops.append(UpdateOne(filt, {'$inc': inc, '$set': {'updated_at': datetime.utcnow()}}, upsert=True))
+    if ops:
+        db[ROLLUP_COLLECTION].bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def mark_stale(dates, db=None):
+    """Record dates whose rollups missed an update, for rebuild_stale()."""
+    dates = sorted(d for d in dates if d)
+    if not dates:
+        return
+    db = db if db is not None else get_db()
+    db[ROLLUP_STATE_COLLECTION].update_one({'_id': 'stale'}, {'$addToSet': {'dates': {'$each': dates}}},
+                                           upsert=True)
+    logging.warning(f'rollups of {dates[0]}..{dates[-1]} marked stale; '
+                    f'run python -m services.ga4.rollups --stale to rebuild them')
+
+
+def stale_dates(db=None):
+    db = db if db is not None else get_db()
+    state = db[ROLLUP_STATE_COLLECTION].find_one({'_id': 'stale'})
+    return sorted(state.get('dates', [])) if state else []
+
+
+def apply_changes(changes, db=None):
+    """
+    Move the rollups by the difference between each saved row and its previous
+    stored version. changes: (row, previous) pairs, previous None for new rows.
+    The first call builds the rollups from every stored row instead. Returns the
+    number of rollup documents updated.
+    """
+    db = db if db is not None else get_db()
+    dates = {row.get('date') for row, _ in changes}
+    state = db[ROLLUP_STATE_COLLECTION].find_one({'_id': 'built'})
+    if state is None:
+        try:
+            db[ROLLUP_STATE_COLLECTION].insert_one({'_id': 'built', 'done': False})
+        except DuplicateKeyError:
+            state = {'done': False}
+        else:
+            return rebuild_all(db)
+    if not state.get('done'):
+        # another job is building them and may have read these rows before they changed
+        mark_stale(dates, db)
+        return 0
+    deltas = {}
+    for row, previous in changes:
+        _add_row(deltas, row)
+        if previous:
+            _add_row(deltas, previous, sign=-1)
+    try:
+        return _write_deltas(deltas, db)
+    except Exception:
+        mark_stale(dates, db)
+        raise
+
+
+def rebuild(start_date, end_date, db=None):
+    """
+    Recompute the rollups of every period that overlaps start_date..end_date from
+    the stored rows, e.g. after a backfill written with ROLLUP_ENABLED=0. Weeks
+    and months reaching past the range are recomputed whole. Run it while no
+    sync writes these dates. Returns the number of rollup documents written.
+    """
+    db = db if db is not None else get_db()
+    periods = {}
+    for p in PERIODS:
+        first, last = period_start(start_date, p), period_start(end_date, p)
+        db[ROLLUP_COLLECTION].delete_many({'period': p, 'start': {'$gte': first, '$lte': last}})
+        periods[p] = (first, last)
+    span_start = min(period_start(start_date, p) for p in PERIODS)
+    span_end = max(_period_end(end_date, p) for p in PERIODS)
+    projection = {f: 1 for f in ['date'] + _ROLLUP_KEYS + COMBINED_METRICS}
+    span = {'$gte': span_start, '$lte': span_end}
+    if buckets.enabled_for(SOURCE_COLLECTION):
+        rows = buckets.find_rows({'d': span}, db)
+    else:
+        rows = db[SOURCE_COLLECTION].find({'date': span}, projection)
+    deltas = {}
+    for row in rows:
+        _add_row(deltas, row, periods=periods)
+    return _write_deltas(deltas, db)
+
+
+def rebuild_stale(db=None):
+    """Rebuild the periods of the dates marked stale by mark_stale(). Returns the number of rollup documents written."""
+    db = db if db is not None else get_db()
+    dates = stale_dates(db)
+    if not dates:
+        return 0
+    written = rebuild(dates[0], dates[-1], db)
+    db[ROLLUP_STATE_COLLECTION].update_one({'_id': 'stale'}, {'$pullAll': {'dates': dates}})
+    return written
+
+
+def rebuild_all(db=None):
+    """Drop every rollup and rebuild them over all stored dates."""
+    db = db if db is not None else get_db()
+    state = db[ROLLUP_STATE_COLLECTION]
+    state.update_one({'_id': 'built'}, {'$set': {'done': False}}, upsert=True)
+    try:
+        written = _rebuild_all(db)
+    except Exception:
+        # the next save tries again
+        state.delete_one({'_id': 'built'})
+        raise
+    state.update_one({'_id': 'built'}, {'$set': {'done': True, 'at': datetime.utcnow()}})
+    return written
+
+
+def _rebuild_all(db):
+    if buckets.enabled_for(SOURCE_COLLECTION):
+        bounds = buckets.date_bounds(db)
+    else:
+        source = db[SOURCE_COLLECTION]
+        first = source.find_one({'date': {'$ne': None}}, {'date': 1}, sort=[('date', ASCENDING)])
+        last = source.find_one({'date': {'$ne': None}}, {'date': 1}, sort=[('date', -1)])
+        bounds = (first['date'], last['date']) if first else None
+    db[ROLLUP_COLLECTION].delete_many({})
+    return rebuild(*bounds, db) if bounds else 0
+
+
+def ensure_rollup_indexes(db=None):
+    db = db if db is not None else get_db()
+    name = f'{ROLLUP_COLLECTION}_natural_key'
+    keys = ['group', 'period', 'start'] + _ROLLUP_KEYS
+    current = db[ROLLUP_COLLECTION].index_information().get(name)
+    if current and [k for k, _ in current['key']] != keys:
+        # the key changed with ROLLUP_DIMENSIONS; rollups keyed the old way need a rebuild_all()
+        db[ROLLUP_COLLECTION].drop_index(name)
+    db[ROLLUP_COLLECTION].create_index([(k, ASCENDING) for k in keys], unique=True, name=name)
+
+
+def read_rollups(period, dimensions=(), start_date=None, end_date=None, filters=None, property_id=None, db=None):
+    """
+    Rollup rows of one period ('day', 'week', 'month') for a configured dimension
+    subset, ordered by period start, with ratio metrics divided back out
+    (None where the weight is 0). start_date/end_date bound the period start;
+    filters narrows by dimension values, e.g. {'country': 'US'}; without a
+    property_id every property's rows are returned.
+    """
+    db = db if db is not None else get_db()
+    query = {'group': group_name(list(dimensions)), 'period': period, **(filters or {})}
+    if property_id:
+        query['property_id'] = str(property_id)
+    if start_date or end_date:
+        query['start'] = {}
+        if start_date:
+            query['start']['$gte'] = period_start(start_date, period)
+        if end_date:
+            query['start']['$lte'] = end_date
+    unused = [k for k in _ROLLUP_KEYS if k != 'property_id' and k not in dimensions]
+    out = []
+    for doc in db[ROLLUP_COLLECTION].find(query, {'_id': 0, 'updated_at': 0}).sort('start', ASCENDING):
+        for k in unused:
+            doc.pop(k, None)
+        for m, weight in ROLLUP_WEIGHTED_METRICS.items():
+            if f'{m}_weighted' in doc:
+                total = doc.get(weight) or 0
+                weighted = doc.pop(f'{m}_weighted')
+                doc[m] = weighted / total if total else None
+        out.append(doc)
+    return out
+
+
+if __name__ == '__main__':
+    # Backfill: python -m services.ga4.rollups START_DATE END_DATE
+    # Repair after failed saves: python -m services.ga4.rollups --stale
+    import sys
+    from db.mongo import init_mongo
+    if sys.argv[1:] != ['--stale'] and len(sys.argv) != 3:
+        sys.exit('usage: python -m services.ga4.rollups START_DATE END_DATE | --stale')
+    init_mongo()
+    ensure_rollup_indexes()
+    written = rebuild_stale() if sys.argv[1:] == ['--stale'] else rebuild(sys.argv[1], sys.argv[2])
+    logging.warning(f'rebuilt {written} rollup documents')
@@ -1,27 +1,40 @@
+# runner: GA4 sync jobs - fetches reports (real or simulated) and saves them through the loader
+#
+# Combined ranges run day by day through services.ga4.pipeline (fetch, convert and
+# write overlap), or with COMBINED_FETCH_STRATEGY='range' in slices of
+# GA_RANGE_SLICE_DAYS with 'date' as a GA dimension, falling back to single days
+# for slices over GA_RANGE_MAX_ROWS rows. Reports are fetched page by page
+# (GA_PAGE_SIZE) and saved in chunks, cached in Redis (services.ga4.cache) and
+# throttled per property (services.ga4.ratelimit); quota errors fail the run
+# instead of falling back to simulation. Simulated rows are used only when GA is
+# not configured or a call fails before any real row of that report was saved.
+# Incremental runs start at the high-water mark (services.ga4.sync_state), which
+# never moves past a date that was simulated.
 import os
-from config import COMBINED_DIMENSIONS, COMBINED_METRICS, DIMENSION_METRIC_MAP, CLIENT_SECRETS_FILE, GA_JOBS
-from services.ga4.processor import process_response
-from services.ga4.loader import save_rows_to_collection
+from config import COMBINED_DIMENSIONS, COMBINED_METRICS, DIMENSION_METRIC_MAP, GA_JOBS, GA_PAGE_SIZE, \
+    COMBINED_FETCH_STRATEGY, GA_RANGE_SLICE_DAYS, GA_RANGE_MAX_ROWS, MAX_METRICS_PER_REQUEST, GA_BATCH_SIZE
+from services.ga4.processor import iter_response_rows, response_size
+from services.ga4.loader import save_rows_in_chunks, add_counts
+from services.ga4.client import get_client, call_with_client, get_client_stats, ga_types, GA_INSTALLED
+from services.ga4 import cache
+from services.ga4.sync_state import incremental_range, advance_watermark
+from services.ga4.pipeline import run_pipeline, DateIncomplete
+from services.ga4.ratelimit import throttled_call, get_limiter_stats, QuotaExhausted
+from services.ga4 import telemetry
 from datetime import datetime, timedelta
+from itertools import groupby
+import time
 import uuid
 
-# Try to import GA client; if not available we'll simulate
-try:
-    from google.oauth2 import service_account
-    from google.analytics.data_v1beta import BetaAnalyticsDataClient
-    from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest
-    _HAS_GA = True
-except Exception:
-    _HAS_GA = False
+# If the GA library is not installed we'll simulate. Its types are imported on first
+# use (ga_types()), and Mongo connects on first use, so importing this module is cheap.
+_HAS_GA = GA_INSTALLED
 
-from db.mongo import init_mongo, get_db
-init_mongo()
-db = get_db()
+from db.mongo import get_db
 
 def get_ga4_client():
-    creds = service_account.Credentials.from_service_account_file(CLIENT_SECRETS_FILE)
-    client = BetaAnalyticsDataClient(credentials=creds)
-    return client
+    # Shared per-process client (see services.ga4.client); kept for callers of the old name
+    return get_client()
 
 def get_mode_counts(mode='both'):
     if mode == 'combined':
@@ -37,26 +50,199 @@ def get_mode_counts(mode='both'):
     }
 
 
-def _build_run_report_request(property_id, dimensions, metrics, start_date='7daysAgo', end_date='today'):
-    # Build request for GA4 Data API with explicit date range
-    dims = [Dimension(name=d) for d in dimensions]
-    mets = [Metric(name=m) for m in metrics]
-    date_ranges = [DateRange(start_date=start_date, end_date=end_date)]
-    return RunReportRequest(property=f"properties/{property_id}", dimensions=dims, metrics=mets, date_ranges=date_ranges)
+class GAFetchError(RuntimeError):
+    """Raised when a GA call fails, so callers can tell it apart from DB errors mid-stream."""
 
 
-def _run_real_report(property_id, dimensions, metrics, start_date='7daysAgo', end_date='today'):
+class RowLimitExceeded(GAFetchError):
+    """Raised when a report has more rows than the caller allowed (max_rows)."""
+
+
+def _build_run_report_request(property_id, dimensions, metrics, start_date='7daysAgo', end_date='today', limit=None, offset=None, order_by=None):
+    # Build request for GA4 Data API with explicit date range (and optional page window)
+    types = ga_types()
+    dims = [types.Dimension(name=d) for d in dimensions]
+    mets = [types.Metric(name=m) for m in metrics]
+    date_ranges = [types.DateRange(start_date=start_date, end_date=end_date)]
+    req = types.RunReportRequest(property=f"properties/{property_id}", dimensions=dims, metrics=mets,
+                                 date_ranges=date_ranges, return_property_quota=True)
+    if order_by:
+        req.order_bys = [types.OrderBy(dimension=types.OrderBy.DimensionOrderBy(dimension_name=order_by))]
+    if limit:
+        req.limit = limit
+    if offset:
+        req.offset = offset
+    return req
+
+
+def _run_real_report(property_id, dimensions, metrics, start_date='7daysAgo', end_date='today', limit=None, offset=None, order_by=None):
     """
     Real GA4 call. Caller can pass start_date and end_date strings (YYYY-MM-DD or relative like '7daysAgo').
     """
     if not _HAS_GA:
         raise RuntimeError('google-analytics-data library not available')
-    client = get_ga4_client()
-    req = _build_run_report_request(property_id, dimensions, metrics, start_date=start_date, end_date=end_date)
-    resp = client.run_report(req)
+    fingerprint = cache.request_fingerprint(property_id, dimensions, metrics, start_date, end_date,
+                                            limit=limit, offset=offset, order_by=order_by)
+    mode, group = telemetry.labels_for_request(dimensions)
+    resp = cache.get(fingerprint)
+    if resp is not None:
+        telemetry.count_call(mode, group, 'cache_hit')
+        return resp
+    req = _build_run_report_request(property_id, dimensions, metrics, start_date=start_date, end_date=end_date,
+                                    limit=limit, offset=offset, order_by=order_by)
+
+    def call():
+        # timed per attempt, so rate-limit waits and quota backoff are not counted as GA latency
+        try:
+            with telemetry.timed('ga_request', mode, group, date=start_date if start_date == end_date else None) as t:
+                resp = call_with_client(lambda client: client.run_report(req))
+                t['rows'], t['bytes'] = len(resp.rows), response_size(resp)
+        except Exception:
+            telemetry.count_call(mode, group, 'error')
+            raise
+        telemetry.count_call(mode, group, 'ok')
+        return resp
+
+    resp = throttled_call(property_id, call)
+    cache.put(fingerprint, resp, end_date)
     return resp
 
 
+def _iter_real_pages(property_id, dimensions, metrics, start_date='7daysAgo', end_date='today', page_size=GA_PAGE_SIZE,
+                     order_by=None, max_rows=None):
+    """
+    Fetch a report page by page (limit/offset) and yield the raw responses, so only
+    one page is held in memory. The first page is requested eagerly, so the common
+    failures (auth, bad request) raise GAFetchError before anything is yielded, and
+    RowLimitExceeded is raised if the report holds more than max_rows rows.
+    """
+    def fetch(offset):
+        try:
+            return _run_real_report(property_id, dimensions, metrics, start_date=start_date, end_date=end_date,
+                                    limit=page_size, offset=offset, order_by=order_by)
+        except QuotaExhausted:
+            # out of quota is not a reason to write simulated data: fail the run instead
+            raise
+        except Exception as e:
+            raise GAFetchError(str(e)) from e
+
+    first = fetch(0)
+    if max_rows and first.row_count > max_rows:
+        raise RowLimitExceeded(f'{first.row_count} rows exceeds limit of {max_rows}')
+
+    def pages():
+        resp = first
+        offset = 0
+        while True:
+            yield resp
+            offset += len(resp.rows)
+            # row_count is the total across all pages; stop on it or on an empty page
+            if not resp.rows or offset >= resp.row_count:
+                return
+            resp = fetch(offset)
+
+    return pages()
+
+
+def _iter_real_report(property_id, dimensions, metrics, start_date='7daysAgo', end_date='today', page_size=GA_PAGE_SIZE,
+                      order_by=None, max_rows=None):
+    """Like _iter_real_pages, but yields converted dict rows."""
+    pages = _iter_real_pages(property_id, dimensions, metrics, start_date=start_date, end_date=end_date,
+                             page_size=page_size, order_by=order_by, max_rows=max_rows)
+    return (row for page in pages for row in iter_response_rows(page))
+
+
+def _plan_mapped_requests(dimension_metric_map, max_metrics=MAX_METRICS_PER_REQUEST):
+    """
+    Split each dimension's metric list into chunks of at most max_metrics.
+    Returns a list of (dimension, metrics_chunk), one per GA report.
+    """
+    plan = []
+    for dim, mets in dimension_metric_map.items():
+        for i in range(0, len(mets), max_metrics):
+            plan.append((dim, mets[i:i + max_metrics]))
+    return plan
+
+
+def _timed_batch_call(breq, dims):
+    """One batch_run_reports call; its latency is split evenly over the reports' dimension groups."""
+    start = time.perf_counter()
+    try:
+        resp = call_with_client(lambda client: client.batch_run_reports(breq))
+    except Exception:
+        for dim in dims:
+            telemetry.count_call('mapped', dim, 'error')
+        raise
+    elapsed = time.perf_counter() - start
+    for dim, report in zip(dims, resp.reports):
+        telemetry.observe('ga_request', elapsed / len(dims), 'mapped', dim, rows=len(report.rows),
+                          nbytes=response_size(report))
+        telemetry.count_call('mapped', dim, 'ok')
+    return resp
+
+
+def _run_real_batch(property_id, plan, start_date='7daysAgo', end_date='today'):
+    """
+    Run the planned (dimension, metrics) reports in batch_run_reports calls of
+    GA_BATCH_SIZE reports each; reports already in the cache are not requested.
+    Returns a list of (dimension, rows, error) in plan order; when a batch fails
+    every report in it gets the exception as error and no rows.
+    """
+    reports = [None] * len(plan)
+    errors = [None] * len(plan)
+    fingerprints = [cache.request_fingerprint(property_id, [dim], mets, start_date, end_date, limit=GA_PAGE_SIZE)
+                    for dim, mets in plan]
+    misses = []
+    for idx, fp in enumerate(fingerprints):
+        reports[idx] = cache.get(fp)
+        if reports[idx] is None:
+            misses.append(idx)
+
+    for i in range(0, len(misses), GA_BATCH_SIZE):
+        batch = misses[i:i + GA_BATCH_SIZE]
+        reqs = [_build_run_report_request(property_id, [plan[idx][0]], plan[idx][1], start_date=start_date,
+                                          end_date=end_date, limit=GA_PAGE_SIZE) for idx in batch]
+        breq = ga_types().BatchRunReportsRequest(property=f"properties/{property_id}", requests=reqs)
+        try:
+            resp = throttled_call(property_id, lambda: _timed_batch_call(breq, [plan[idx][0] for idx in batch]))
+        except QuotaExhausted:
+            raise
+        except Exception as e:
+            for idx in batch:
+                errors[idx] = e
+            continue
+        for idx, report in zip(batch, resp.reports):
+            reports[idx] = report
+            cache.put(fingerprints[idx], report, end_date)
+
+    out = []
+    for (dim, mets), report, error in zip(plan, reports, errors):
+        if error:
+            out.append((dim, [], error))
+            continue
+        try:
+            if report.row_count > len(report.rows):
+                # Truncated: page through this report on its own
+                rows = list(_iter_real_report(property_id, [dim], mets, start_date=start_date, end_date=end_date))
+            else:
+                with telemetry.timed('convert', 'mapped', dim) as t:
+                    rows = list(iter_response_rows(report))
+                    t['rows'] = len(rows)
+            out.append((dim, rows, None))
+        except GAFetchError as e:
+            out.append((dim, [], e))
+    return out
+
+
+def _merge_chunk_rows(dim, row_lists):
+    """Merge the rows of several metric chunks for one dimension back into one row per dimension value."""
+    merged = {}
+    for rows in row_lists:
+        for r in rows:
+            merged.setdefault(r[dim], {}).update(r)
+    return list(merged.values())
+
+
 def _simulate_report(dimensions, metrics, date_str=None, rows=5):
     """
     Produce simulated rows matching requested dimensions/metrics.
@@ -80,23 +266,182 @@ def _simulate_report(dimensions, metrics, date_str=None, rows=5):
     return out
 
 
-def run_ga(mode='combined', start_date=None, end_date=None, job_id=None):
+def _stamp_rows(rows, date_str=None, property_id=None):
+    # Add the date field to every row (important: we don't add 'date' as GA dimension),
+    # and the property, which is part of every natural key
+    for r in rows:
+        if date_str:
+            r['date'] = date_str
+        if property_id:
+            r['property_id'] = property_id
+        yield r
+
+
+def _counted(rows, seen):
+    # count the rows that went out, so a failure can tell whether real data was already saved
+    for r in rows:
+        seen[0] += 1
+        yield r
+
+
+def _sync_report(colname, property_id, dims, mets, start_date=None, end_date=None, date_str=None, sample_size=2):
+    """
+    Stream one report from GA (or simulation) into colname in chunks.
+    Returns (inserted, rows_count, sample, error); error is the GA exception when
+    the real call failed before any row arrived and simulated rows were saved
+    instead. A failure after real rows were saved is raised as GAFetchError, so
+    real and simulated rows are never mixed. DB errors propagate.
+    Safe to call from worker threads.
+    """
+    def saved(rows):
+        return save_rows_in_chunks(colname, _stamp_rows(rows, date_str, property_id), sample_size=sample_size)
+
+    dates = {'start_date': start_date, 'end_date': end_date} if start_date else {}
+    seen = [0]
+    try:
+        if property_id and _HAS_GA:
+            inserted, count, sample = saved(_counted(_iter_real_report(property_id, dims, mets, **dates), seen))
+        else:
+            inserted, count, sample = saved(_simulate_report(dims, mets, date_str=date_str))
+        return inserted, count, sample, None
+    except GAFetchError as e:
+        if seen[0]:
+            raise GAFetchError(f'GA report failed after {seen[0]} rows were saved: {e}') from e
+        # On a GA failure fallback to simulation and report the error
+        inserted, count, sample = saved(_simulate_report(dims, mets, date_str=date_str))
+        return inserted, count, sample, e
+
+
+def _sync_dates_per_day(property_id, dims, mets, dates, pipeline_stats=None, on_date_done=None, partial=()):
+    """
+    Sync each date with its own request through the fetch -> process -> write
+    pipeline (services.ga4.pipeline); up to GA_FETCH_CONCURRENCY dates are fetched
+    at a time. Yields (date_str, inserted, rows_count, sample, warning) in date order.
+    on_date_done(date_str, inserted, rows_count, warning) runs as each date is fully written.
+    A failed date falls back to simulation, unless it already holds real rows (some of
+    its pages arrived, or it is in partial); it is then left unfinished for resume.
+    """
+    def fetch_date(date_str, emit):
+        # request filtered to the specific date (start==end)
+        pages = 0
+        try:
+            if property_id and _HAS_GA:
+                for page in _iter_real_pages(property_id, dims, mets, start_date=date_str, end_date=date_str):
+                    emit(page)
+                    pages += 1
+            else:
+                emit(_simulate_report(dims, mets, date_str=date_str))
+            return None
+        except GAFetchError as e:
+            if pages or date_str in partial:
+                raise DateIncomplete(f'{date_str}: real GA call failed: {str(e)} - date only partly synced, '
+                                     f'resume the job to fetch it again.')
+            # On a GA failure fallback to simulation for that date and include warning
+            emit(_simulate_report(dims, mets, date_str=date_str))
+            return f'{date_str}: real GA call failed: {str(e)} - simulation used.'
+
+    yield from run_pipeline('combined_dimensions', dates, fetch_date, stats=pipeline_stats,
+                            on_date_done=on_date_done, fields={'property_id': property_id} if property_id else None)
+
+
+def _sync_dates_by_range(property_id, dims, mets, dates, pipeline_stats=None, on_date_done=None):
+    """
+    Sync dates in slices of GA_RANGE_SLICE_DAYS with one report per slice, adding
+    'date' as a dimension and splitting rows per day on our side. A slice falls back
+    to _sync_dates_per_day when it would exceed GA_RANGE_MAX_ROWS or the GA call fails.
+    Yields (date_str, inserted, rows_count, sample, warning) in date order.
+    """
+    empty = {'inserted': 0, 'modified': 0, 'skipped': 0}
+    on_date_done = on_date_done or (lambda *args: None)
+    for i in range(0, len(dates), GA_RANGE_SLICE_DAYS):
+        slice_dates = dates[i:i + GA_RANGE_SLICE_DAYS]
+        done = []
+        started = None
+        try:
+            rows = _iter_real_report(property_id, dims + ['date'], mets, start_date=slice_dates[0],
+                                     end_date=slice_dates[-1], order_by='date', max_rows=GA_RANGE_MAX_ROWS)
+            # ordered by date, so each day's rows arrive contiguously
+            for ga_date, day_rows in groupby(rows, key=lambda r: r['date']):
+                date_str = f'{ga_date[:4]}-{ga_date[4:6]}-{ga_date[6:]}'
+                # days GA has no rows for are still reported, as the per-day loop does
+                for missing in slice_dates[len(done):slice_dates.index(date_str)]:
+                    done.append(missing)
+                    on_date_done(missing, dict(empty), 0, None)
+                    yield missing, dict(empty), 0, [], None
+                day_rows = _stamp_rows(day_rows, date_str, property_id)
+                started = date_str
+                inserted, count, sample = save_rows_in_chunks('combined_dimensions', day_rows)
+                done.append(date_str)
+                on_date_done(date_str, inserted, count, None)
+                yield date_str, inserted, count, sample, None
+            for missing in slice_dates[len(done):]:
+                done.append(missing)
+                on_date_done(missing, dict(empty), 0, None)
+                yield missing, dict(empty), 0, [], None
+        except GAFetchError:
+            # Too many rows or a failed call: redo the days not yet saved one request at a time;
+            # a day cut off mid-save already holds real rows, so it is not simulated
+            partial = {started} if started and started not in done else set()
+            yield from _sync_dates_per_day(property_id, dims, mets, slice_dates[len(done):], pipeline_stats,
+                                           on_date_done, partial)
+
+
+def _checkpointer(jobs_collection, job_id):
+    """
+    Record each finished date under checkpoints.<date> of the job document, so an
+    interrupted job can be resumed with only its unfinished dates
+    (services.queue.resume). Dates that fell back to simulation are 'simulated'
+    and count as unfinished.
+    """
+    def checkpoint(date_str, inserted, rows_count, warning):
+        key = f'checkpoints.{date_str}'
+        jobs_collection.update_one(
+            {"_id": job_id},
+            {"$set": {f'{key}.status': 'simulated' if warning else 'done',
+                      f'{key}.rows_count': rows_count,
+                      f'{key}.inserted': inserted,
+                      f'{key}.at': datetime.now(),
+                      "updated_at": datetime.now()}}
+        )
+    return checkpoint if job_id else None
+
+
+def _attach_stats(results, before):
+    # Client counters are per process; cache and quota counters are reported for this run only
+    results['ga_client'] = get_client_stats()
+    for name, current in (('ga_cache', cache.get_cache_stats()), ('ga_quota', get_limiter_stats())):
+        results[name] = {k: round(v - before[name].get(k, 0), 3) for k, v in current.items()}
+    results['timings'] = telemetry.job_summary()
+    telemetry.flush()
+    return results
+
+
+def run_ga(mode='combined', start_date=None, end_date=None, job_id=None, incremental=False, dates=None,
+           property_id=None):
     """
-    Backwards-compatible entrypoint.
+    Backwards-compatible entrypoint: sync one GA4 property into Mongo.
 
-    Signature:
-        run_ga(mode='combined', start_date=None, end_date=None)
+    - mode: 'combined' (COMBINED_DIMENSIONS, one row per date) or 'mapped'
+      (one undated report per DIMENSION_METRIC_MAP entry).
+    - start_date/end_date (YYYY-MM-DD, combined): the inclusive range to sync;
+      without them (or with only mode) it behaves exactly as before.
+    - job_id: the GA_JOBS document to update; each date is checkpointed in it once written.
+    - incremental (combined): ignore start_date/end_date and sync from the stored
+      high-water mark through yesterday.
+    - dates (combined): sync just these dates, e.g. the unfinished dates of a resumed job.
+    - property_id: the GA4 property (default GA4_PROPERTY_ID); without one, or
+      without the GA client, rows are simulated.
 
-    - If called with only mode (or no args), behaves exactly as before.
-    - If mode == 'combined' and start_date/end_date are provided (YYYY-MM-DD),
-      it will iterate each date in the inclusive range, call GA for that date
-      (start_date=end_date=current_date) and save the 'date' key into each row.
-    - If GA client or GA4 property is not configured, simulation is used (same as before).
+    Returns the inserted/modified/skipped counts and a sample of rows, plus this
+    run's 'ga_client', 'ga_cache', 'ga_quota', 'timings' and (for per-day ranges)
+    'pipeline' statistics.
     """
-    property_id = os.getenv('GA4_PROPERTY_ID')
+    property_id = str(property_id or os.getenv('GA4_PROPERTY_ID') or '') or None
     results = {}
+    stats_before = {'ga_cache': cache.get_cache_stats(), 'ga_quota': get_limiter_stats()}
+    telemetry.start_job()
 
-    jobs_collection = db[GA_JOBS]
+    jobs_collection = get_db()[GA_JOBS]
 
     if job_id:
         jobs_collection.update_one(
@@ -104,6 +449,26 @@ def run_ga(mode='combined', start_date=None, end_date=None, job_id=None):
             {"$set": {"status": "in_progress", "started_at": datetime.now()}}
         )
 
+    if incremental:
+        # Mapped reports carry no date, so there is nothing to take a mark from
+        if mode != 'combined':
+            raise ValueError('incremental sync is only supported for combined mode')
+        date_range = incremental_range(mode, 'combined_dimensions', property_id=property_id)
+        if not date_range:
+            results['incremental'] = {'up_to_date': True}
+            results['counts'] = get_mode_counts('combined')
+            return _attach_stats(results, stats_before)
+        start_date, end_date = date_range
+
+    if dates:
+        if mode != 'combined':
+            raise ValueError('dates can only be given for combined mode')
+        try:
+            dates = sorted({datetime.strptime(d, "%Y-%m-%d").strftime("%Y-%m-%d") for d in dates})
+        except (TypeError, ValueError) as ve:
+            raise ValueError("dates must be in YYYY-MM-DD format") from ve
+        start_date, end_date = dates[0], dates[-1]
+
     # Combined mode supports optional date-range per-day iteration
     if mode == 'combined':
         dims = COMBINED_DIMENSIONS
@@ -120,74 +485,93 @@ def run_ga(mode='combined', start_date=None, end_date=None, job_id=None):
             if start > end:
                 raise ValueError("start_date must be <= end_date")
 
-            all_rows = []
+            explicit_dates = bool(dates)
+            if not explicit_dates:
+                dates = []
+                current = start
+                while current <= end:
+                    dates.append(current.strftime("%Y-%m-%d"))
+                    current += timedelta(days=1)
+                if job_id:
+                    # the full range a resume is measured against
+                    jobs_collection.update_one(
+                        {"_id": job_id},
+                        {"$set": {"range": {"start_date": start_date, "end_date": end_date}}}
+                    )
+            checkpoint = _checkpointer(jobs_collection, job_id)
+
+            total_rows = 0
+            totals = {'inserted': 0, 'modified': 0, 'skipped': 0}
             per_date_results = []
-            current = start
-            while current <= end:
-                date_str = current.strftime("%Y-%m-%d")
-                try:
-                    # request filtered to the specific date (start==end)
-                    if property_id and _HAS_GA:
-                        resp = _run_real_report(property_id, dims, mets, start_date=date_str, end_date=date_str)
-                        rows = process_response(resp)
-                    else:
-                        rows = _simulate_report(dims, mets, date_str=date_str)
-                except Exception as e:
-                    # On any exception fallback to simulation for that date and include warning
-                    rows = _simulate_report(dims, mets, date_str=date_str)
-                    results.setdefault('warnings', []).append(f'{date_str}: real GA call failed: {str(e)} - simulation used.')
-
-                # Add the date field to every row (important: we don't add 'date' as GA dimension)
-                for r in rows:
-                    r['date'] = date_str
-
-                # Save rows for this date
-                inserted = save_rows_to_collection('combined_dimensions', rows)
-                per_date_results.append({'date': date_str, 'inserted': inserted, 'rows_count': len(rows)})
-                all_rows.extend(rows)
-                current += timedelta(days=1)
+            rows_sample = []
+            first_failed = None
+            # Each date is streamed straight into Mongo, so only counts and a sample come back
+            pipeline_stats = {}
+            # range slices assume consecutive days, so an explicit (possibly gappy) date list goes per day
+            if COMBINED_FETCH_STRATEGY == 'range' and property_id and _HAS_GA and not explicit_dates:
+                synced = _sync_dates_by_range(property_id, dims, mets, dates, pipeline_stats, checkpoint)
+            else:
+                synced = _sync_dates_per_day(property_id, dims, mets, dates, pipeline_stats, checkpoint)
+            for date_str, inserted, count, sample, warning in synced:
+                if warning:
+                    results.setdefault('warnings', []).append(warning)
+                    first_failed = first_failed or date_str
+                per_date_results.append({'date': date_str, 'inserted': inserted, 'rows_count': count})
+                total_rows += count
+                add_counts(totals, inserted)
+                rows_sample.extend(sample[:2 - len(rows_sample)])
 
             results['per_date'] = per_date_results
-            results['inserted'] = {'inserted': len(all_rows), 'modified': 0}
-            results['rows_sample'] = all_rows[:2]
+            results['inserted'] = totals
+            results['rows_count'] = total_rows
+            results['rows_sample'] = rows_sample
             results['counts'] = get_mode_counts('combined')
-            return results
+            if pipeline_stats:
+                results['pipeline'] = pipeline_stats
 
-        # If no date range was provided, keep old behavior (single run)
-        try:
-            if property_id and _HAS_GA:
-                resp = _run_real_report(property_id, dims, mets)
-                rows = process_response(resp)
-            else:
-                rows = _simulate_report(dims, mets)
-        except Exception as e:
-            rows = _simulate_report(dims, mets)
-            results['warning'] = f'Real GA call failed: {e} - simulation used.'
+            if incremental:
+                # Only dates saved from real GA data count as synced
+                synced_dates = [d for d in dates if not first_failed or d < first_failed]
+                if synced_dates:
+                    advance_watermark(mode, 'combined_dimensions', synced_dates[-1], job_id=job_id,
+                                      property_id=property_id)
+                results['incremental'] = {'start_date': start_date, 'end_date': end_date,
+                                          'watermark': synced_dates[-1] if synced_dates else None}
+            return _attach_stats(results, stats_before)
 
-        inserted = save_rows_to_collection('combined_dimensions', rows)
+        # If no date range was provided, keep old behavior (single run)
+        inserted, _, sample, error = _sync_report('combined_dimensions', property_id, dims, mets)
+        if error:
+            results['warning'] = f'Real GA call failed: {error} - simulation used.'
         results['inserted'] = inserted
-        results['rows_sample'] = rows[:2]
+        results['rows_sample'] = sample
         results['counts'] = get_mode_counts('combined')
-        return results
+        return _attach_stats(results, stats_before)
 
-    # Mapped mode: unchanged behavior (no date iteration)
+    # Mapped mode: no date iteration. Metric lists are split to MAX_METRICS_PER_REQUEST
+    # and sent as batch_run_reports calls, then merged back per dimension value.
     if mode == 'mapped':
         all_inserted = {}
+        chunks = {}
+        errors = {}
+        if property_id and _HAS_GA:
+            for dim, rows, error in _run_real_batch(property_id, _plan_mapped_requests(DIMENSION_METRIC_MAP)):
+                chunks.setdefault(dim, []).append(rows)
+                if error and dim not in errors:
+                    errors[dim] = error
         for dim, mets in DIMENSION_METRIC_MAP.items():
-            try:
-                if property_id and _HAS_GA:
-                    resp = _run_real_report(property_id, [dim], mets)
-                    rrows = process_response(resp)
-                else:
-                    rrows = _simulate_report([dim], mets)
-            except Exception as e:
+            if dim in chunks and dim not in errors:
+                rrows = _merge_chunk_rows(dim, chunks[dim])
+            else:
                 rrows = _simulate_report([dim], mets)
-                results.setdefault('warnings', []).append(f'{dim}: real GA call failed: {e} - simulation used.')
+                if dim in errors:
+                    results.setdefault('warnings', []).append(f'{dim}: real GA call failed: {errors[dim]} - simulation used.')
             colname = f'ga_{dim}'
-            inserted = save_rows_to_collection(colname, rrows)
-            all_inserted[dim] = {'collection': colname, 'inserted': inserted, 'sample': rrows[:1]}
+            inserted, _, sample = save_rows_in_chunks(colname, _stamp_rows(rrows, property_id=property_id),
+                                                      sample_size=1)
+            all_inserted[dim] = {'collection': colname, 'inserted': inserted, 'sample': sample}
         results['mapped'] = all_inserted
         results['counts'] = get_mode_counts('mapped')
-        return results
+        return _attach_stats(results, stats_before)
 
     raise ValueError('mode must be combined or mapped')
@@ -0,0 +1,57 @@
+# sync_state: per-property, per-mode, per-collection high-water marks for incremental syncs
+from datetime import datetime, timedelta
+from db.mongo import get_db
+from config import SYNC_STATE_COLLECTION, INCREMENTAL_LOOKBACK_DAYS, INCREMENTAL_INITIAL_DAYS, GA4_PROPERTY_ID
+
+
+def _state_id(mode, collection_name, property_id=None):
+    # marks from before multi-property sync have no property prefix
+    if property_id:
+        return f'{property_id}:{mode}:{collection_name}'
+    return f'{mode}:{collection_name}'
+
+
+def get_watermark(mode, collection_name, property_id=None):
+    """Return the last fully synced date (YYYY-MM-DD) for mode/collection, or None if never synced."""
+    state = get_db()[SYNC_STATE_COLLECTION]
+    doc = state.find_one({'_id': _state_id(mode, collection_name, property_id)})
+    if doc is None and property_id and property_id == GA4_PROPERTY_ID:
+        # the default property carries on from the mark written before marks were per property
+        doc = state.find_one({'_id': _state_id(mode, collection_name)})
+    return doc.get('last_synced_date') if doc else None
+
+
+def advance_watermark(mode, collection_name, date_str, job_id=None, property_id=None):
+    """
+    Move the mark forward to date_str in a single atomic update. $max keeps the
+    mark from moving backwards when an older range finishes after a newer one
+    (YYYY-MM-DD strings compare in date order).
+    """
+    get_db()[SYNC_STATE_COLLECTION].update_one(
+        {'_id': _state_id(mode, collection_name, property_id)},
+        {
+            '$max': {'last_synced_date': date_str},
+            '$set': {'mode': mode, 'collection': collection_name, 'property_id': property_id, 'last_job_id': job_id,
+                     'updated_at': datetime.utcnow()},
+        },
+        upsert=True,
+    )
+
+
+def incremental_range(mode, collection_name, today=None, property_id=None):
+    """
+    Dates to fetch for an incremental run, as (start_date, end_date) strings, or None
+    when already up to date. The range runs from the day after the mark, minus
+    INCREMENTAL_LOOKBACK_DAYS re-checked for late GA data, through yesterday.
+    Without a mark, the last INCREMENTAL_INITIAL_DAYS days are fetched.
+    """
+    today = today or datetime.now().date()
+    end = today - timedelta(days=1)
+    mark = get_watermark(mode, collection_name, property_id)
+    if mark:
+        start = datetime.strptime(mark, '%Y-%m-%d').date() + timedelta(days=1 - INCREMENTAL_LOOKBACK_DAYS)
+    else:
+        start = end - timedelta(days=INCREMENTAL_INITIAL_DAYS - 1)
+    if start > end:
+        return None
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
@@ -0,0 +1,177 @@
+# telemetry: per-stage timings of GA requests, response conversion and Mongo writes
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from config import COMBINED_DIMENSIONS, METRICS_ENABLED
+from services.queue.setup import redis_conn
+
+# Redis hash holding every series, summed over all workers; field = series name with labels
+_METRICS_KEY = 'ga_metrics'
+# Upper bounds (seconds) of the stage latency histogram buckets
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_HELP = {
+    'ga_stage_duration_seconds': ('histogram', 'Time spent per call in a sync stage (ga_request, convert, mongo_write)'),
+    'ga_stage_rows_total': ('counter', 'Rows handled by a sync stage'),
+    'ga_response_bytes_total': ('counter', 'Serialized size of GA report responses'),
+    'ga_api_calls_total': ('counter', 'GA report requests by outcome (ok, error, cache_hit)'),
+}
+
+_lock = threading.Lock()
+# series -> increment not yet pushed to Redis
+_pending = {}
+# summary of the job running in this process, see start_job()
+_job = {'stages': {}, 'per_date': {}}
+
+
+def labels_for_request(dimensions):
+    """(mode, dimension group) of a GA report over these dimensions."""
+    dims = [d for d in dimensions if d != 'date']
+    if set(dims) == set(COMBINED_DIMENSIONS):
+        return 'combined', 'combined'
+    return 'mapped', dims[0] if dims else ''
+
+
+def labels_for_collection(collection_name):
+    """(mode, dimension group) of the rows saved into collection_name."""
+    if collection_name == 'combined_dimensions':
+        return 'combined', 'combined'
+    return 'mapped', collection_name[len('ga_'):] if collection_name.startswith('ga_') else collection_name
+
+
+def _series(name, **labels):
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+def _add(series, value):
+    _pending[series] = _pending.get(series, 0) + value
+
+
+def observe(stage, seconds, mode, group, rows=0, nbytes=0, date=None):
+    """
+    Record one call of a stage. Feeds the cross-worker Prometheus series (labelled
+    by stage, mode and dimension group) and this process's job summary, which
+    also keeps a per-date breakdown.
+    """
+    if not METRICS_ENABLED:
+        return
+    labels = {'stage': stage, 'mode': mode, 'group': group}
+    with _lock:
+        for le in _BUCKETS:
+            if seconds <= le:
+                _add(_series('ga_stage_duration_seconds_bucket', le=le, **labels), 1)
+        _add(_series('ga_stage_duration_seconds_bucket', le='+Inf', **labels), 1)
+        _add(_series('ga_stage_duration_seconds_sum', **labels), seconds)
+        _add(_series('ga_stage_duration_seconds_count', **labels), 1)
+        if rows:
+            _add(_series('ga_stage_rows_total', **labels), rows)
+        if nbytes:
+            _add(_series('ga_response_bytes_total', mode=mode, group=group), nbytes)
+
+        entries = [_job['stages'].setdefault(f'{stage}:{group}', {'stage': stage, 'mode': mode, 'group': group,
+                                                                  'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})]
+        if date:
+            entries.append(_job['per_date'].setdefault(date, {}).setdefault(stage, {'calls': 0, 'seconds': 0.0,
+                                                                                      'rows': 0, 'bytes': 0}))
+        for entry in entries:
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['rows'] += rows
+            entry['bytes'] += nbytes
+
+
+def count_call(mode, group, outcome):
+    """Count one GA report request: outcome is 'ok', 'error' or 'cache_hit'."""
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _add(_series('ga_api_calls_total', mode=mode, group=group, outcome=outcome), 1)
+
+
+@contextmanager
+def timed(stage, mode, group, date=None):
+    """
+    Time the block as one call of stage. The block may set 'rows' and 'bytes' on
+    the yielded dict; nothing is recorded if it raises.
+    """
+    info = {'rows': 0, 'bytes': 0}
+    start = time.perf_counter()
+    yield info
+    observe(stage, time.perf_counter() - start, mode, group, rows=info['rows'], nbytes=info['bytes'], date=date)
+
+
+def start_job():
+    """Reset the job summary; called when a run starts in this process."""
+    with _lock:
+        _job['stages'] = {}
+        _job['per_date'] = {}
+
+
+def job_summary():
+    """
+    Per-stage totals of the current job, with rows per second, and the same per
+    date. Stored with the job result in ga_jobs.
+    """
+    def rounded(entry):
+        out = dict(entry)
+        out['seconds'] = round(entry['seconds'], 4)
+        out['rows_per_s'] = round(entry['rows'] / entry['seconds'], 1) if entry['seconds'] else None
+        return out
+
+    with _lock:
+        return {
+            'stages': [rounded(e) for e in _job['stages'].values()],
+            'per_date': {d: {stage: rounded(e) for stage, e in stages.items()}
+                         for d, stages in sorted(_job['per_date'].items())},
+        }
+
+
+def flush():
+    """Push this process's pending increments into the shared Redis hash."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for series, value in pending.items():
+            pipe.hincrbyfloat(_METRICS_KEY, series, value)
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"Could not push metrics to Redis, {len(pending)} series dropped: {e}")
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_prometheus():
+    """All workers' series from Redis in the Prometheus text exposition format."""
+    flush()
+    raw = redis_conn.hgetall(_METRICS_KEY)
+    by_metric = {}
+    for series, value in raw.items():
+        series = series.decode() if isinstance(series, bytes) else series
+        name = series.split('{', 1)[0]
+        for base in _HELP:
+            if name == base or (_HELP[base][0] == 'histogram' and name.startswith(base + '_')):
+                by_metric.setdefault(base, []).append((series, float(value)))
+                break
+    lines = []
+    for base, (kind, text) in _HELP.items():
+        lines.append(f'# HELP {base} {text}')
+        lines.append(f'# TYPE {base} {kind}')
+        for series, value in sorted(by_metric.get(base, []), key=_sort_key):
+            lines.append(f'{series} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _sort_key(item):
+    # keep histogram buckets in ascending 'le' order within their series
+    series = item[0]
+    if 'le="' not in series:
+        return series, 0.0
+    le = series.split('le="', 1)[1].split('"', 1)[0]
+    return series.replace(f'le="{le}"', ''), float('inf') if le == '+Inf' else float(le)
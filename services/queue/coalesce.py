@@ -0,0 +1,136 @@
+# services/queue/coalesce.py
+# Redis index of in-flight /ga/run requests, so duplicate and overlapping runs share jobs
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from config import COALESCE_ENABLED, COALESCE_TTL
+from services.queue.setup import redis_conn
+
+# KEYS[1] request key, KEYS[2] set of keys held by the job, KEYS[3..] one key per date.
+# Returns {existing job id or '', owner of each date...}; dates nobody holds are taken
+# by ARGV[1]. The request key is only taken when the job has something of its own to do.
+_CLAIM_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing then return {existing} end
+local result = {''}
+local claimed = 0
+for i = 3, #KEYS do
+  if redis.call('SET', KEYS[i], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    claimed = claimed + 1
+    redis.call('SADD', KEYS[2], KEYS[i])
+    result[#result + 1] = ARGV[1]
+  else
+    result[#result + 1] = redis.call('GET', KEYS[i])
+  end
+end
+if claimed > 0 or #KEYS == 2 then
+  redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+  redis.call('SADD', KEYS[2], KEYS[1])
+  redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return result
+"""
+
+# Drop every key still held by job ARGV[1]; keys since re-taken by another job are left alone
+_RELEASE_SCRIPT = """
+local keys = redis.call('SMEMBERS', KEYS[1])
+for _, key in ipairs(keys) do
+  if redis.call('GET', key) == ARGV[1] then redis.call('DEL', key) end
+end
+redis.call('DEL', KEYS[1])
+return #keys
+"""
+
+
+class Claim:
+    """
+    Outcome of registering a run request:
+      - existing_job_id: an identical request is in flight; use that job instead
+      - dates: the dates this job must sync itself (None when not date based)
+      - covered_by: {date: job_id} for dates another in-flight job is already syncing
+    """
+
+    def __init__(self, existing_job_id=None, dates=None, covered_by=None):
+        self.existing_job_id = existing_job_id
+        self.dates = dates
+        self.covered_by = covered_by or {}
+
+    @property
+    def fully_covered(self):
+        return self.dates == [] and bool(self.covered_by)
+
+
+def normalize_request(mode, start_date=None, end_date=None, incremental=False, property_id=None):
+    """
+    Canonical form of a /ga/run request for property_id (default GA4_PROPERTY_ID).
+    Incremental runs ignore their dates; a bad date is left as sent, the runner reports it.
+    """
+    request = {'property': str(property_id or os.getenv('GA4_PROPERTY_ID') or ''),
+               'mode': (mode or 'combined').strip().lower(),
+               'incremental': bool(incremental), 'start_date': None, 'end_date': None}
+    if not incremental:
+        for field, value in (('start_date', start_date), ('end_date', end_date)):
+            try:
+                request[field] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except (TypeError, ValueError):
+                request[field] = value
+    return request
+
+
+def request_hash(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def _dates(request):
+    """Dates of a combined range request, or [] if it is not one (or not a valid one)."""
+    if request['mode'] != 'combined' or request['incremental']:
+        return []
+    try:
+        start = datetime.strptime(request['start_date'], '%Y-%m-%d')
+        end = datetime.strptime(request['end_date'], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return []
+    dates = []
+    while start <= end:
+        dates.append(start.strftime('%Y-%m-%d'))
+        start += timedelta(days=1)
+    return dates
+
+
+def claim(job_id, mode, start_date=None, end_date=None, incremental=False, property_id=None):
+    """
+    Register job_id as the run for this request in one Redis round trip. Identical
+    requests get the existing job; for combined ranges each date is held by the
+    first job to ask for it. Without Redis every request runs as submitted.
+    """
+    request = normalize_request(mode, start_date, end_date, incremental, property_id)
+    dates = _dates(request)
+    if not COALESCE_ENABLED:
+        return Claim(dates=dates or None)
+    prefix = f"ga_inflight:{request['property']}:{request['mode']}"
+    keys = [f'{prefix}:req:{request_hash(request)}', f'ga_inflight:job:{job_id}']
+    keys += [f'{prefix}:date:{d}' for d in dates]
+    try:
+        result = redis_conn.eval(_CLAIM_SCRIPT, len(keys), *keys, job_id, COALESCE_TTL)
+    except Exception as e:
+        logging.warning(f"Run coalescing unavailable, request not checked for duplicates: {e}")
+        return Claim(dates=dates or None)
+
+    result = [r.decode() if isinstance(r, bytes) else r for r in result]
+    if result[0]:
+        return Claim(existing_job_id=result[0])
+    owners = dict(zip(dates, result[1:]))
+    return Claim(dates=[d for d in dates if owners[d] == job_id] if dates else None,
+                 covered_by={d: owner for d, owner in owners.items() if owner != job_id})
+
+
+def release(job_id):
+    """Remove job_id from the in-flight index once it has finished (or failed)."""
+    if not (COALESCE_ENABLED and job_id):
+        return
+    try:
+        redis_conn.eval(_RELEASE_SCRIPT, 1, f'ga_inflight:job:{job_id}', job_id)
+    except Exception as e:
+        logging.warning(f"Could not release in-flight entries of job {job_id}: {e}")
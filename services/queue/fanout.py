@@ -0,0 +1,138 @@
+# services/queue/fanout.py
+# Split large date ranges into child jobs on ga_queue and aggregate their results
+from datetime import datetime, timedelta
+from uuid import uuid4
+from rq.job import Dependency
+from config import GA_JOBS, FANOUT_CHUNK_DAYS
+from db.mongo import get_db
+from services.queue.setup import ga_queue
+from services.queue import scheduler
+from services.queue.task_wrapper import enqueueable_run
+from services.queue.coalesce import release
+from services.ga4.loader import add_counts
+
+
+def _jobs_collection():
+    return get_db()[GA_JOBS]
+
+
+def split_date_range(start_date, end_date, chunk_days=FANOUT_CHUNK_DAYS):
+    """Split an inclusive YYYY-MM-DD range into [(chunk_start, chunk_end), ...] of at most chunk_days days."""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + timedelta(days=chunk_days - 1), end)
+        chunks.append((start.strftime("%Y-%m-%d"), chunk_end.strftime("%Y-%m-%d")))
+        start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+def should_fan_out(mode, start_date, end_date):
+    """Only combined date ranges longer than one chunk are worth splitting."""
+    if mode != 'combined' or not (start_date and end_date):
+        return False
+    try:
+        return len(split_date_range(start_date, end_date)) > 1
+    except ValueError:
+        # let the runner report the bad dates as usual
+        return False
+
+
+def enqueue_fanout(parent_job_id, mode, start_date, end_date, job_timeout=1000, property_id=None):
+    """
+    Enqueue one child job per date chunk plus an aggregation job that runs once
+    every child has finished (failed or not). Child job documents point back to
+    the parent via parent_job_id; the parent lists its children. The children
+    are submitted through the property's fair-scheduling slots (services.queue.scheduler).
+    """
+    child_ids = []
+    child_jobs = []
+    for chunk_start, chunk_end in split_date_range(start_date, end_date):
+        child_id = str(uuid4())
+        _jobs_collection().insert_one({
+            "_id": child_id,
+            "parent_job_id": parent_job_id,
+            "mode": mode,
+            "start_date": chunk_start,
+            "end_date": chunk_end,
+            "property_id": property_id,
+            "status": "queued",
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        })
+        child_jobs.append(scheduler.submit(property_id, enqueueable_run, (mode, chunk_start, chunk_end),
+                                           {'queue_job_id': child_id, 'property_id': property_id},
+                                           job_timeout=job_timeout))
+        child_ids.append(child_id)
+
+    _jobs_collection().update_one(
+        {"_id": parent_job_id},
+        {"$set": {"children": child_ids, "updated_at": datetime.now()}}
+    )
+    ga_queue.enqueue(aggregate_children, parent_job_id,
+                     depends_on=Dependency(jobs=child_jobs, allow_failure=True))
+    return child_ids
+
+
+def get_children_progress(parent_job_id):
+    """Count a parent's children by state, or None if the job was not fanned out."""
+    parent = _jobs_collection().find_one({"_id": parent_job_id})
+    if not parent or not parent.get("children"):
+        return None
+    progress = {"total": len(parent["children"]), "queued": 0, "in_progress": 0, "completed": 0, "failed": 0}
+    for child in _jobs_collection().find({"parent_job_id": parent_job_id}):
+        status = child.get("status") or "queued"
+        if status == "Job Processed":
+            progress["completed"] += 1
+        elif status.startswith("Job Failed"):
+            progress["failed"] += 1
+        elif status == "in_progress":
+            progress["in_progress"] += 1
+        else:
+            progress["queued"] += 1
+    return progress
+
+
+def aggregate_children(parent_job_id):
+    """
+    Final step of a fanned-out run: merge the children's per-date results, in
+    date order, into one result shaped like a single combined run_ga result.
+    """
+    children = sorted(_jobs_collection().find({"parent_job_id": parent_job_id}), key=lambda c: c["start_date"])
+    result = {"per_date": [], "inserted": {"inserted": 0, "modified": 0, "skipped": 0}, "rows_count": 0,
+              "rows_sample": [], "chunks": []}
+    failed = 0
+    for child in children:
+        child_result = child.get("result")
+        ok = child.get("status") == "Job Processed" and isinstance(child_result, dict) and "error" not in child_result
+        result["chunks"].append({"job_id": child["_id"], "start_date": child["start_date"],
+                                 "end_date": child["end_date"], "status": child.get("status")})
+        if not ok:
+            failed += 1
+            result.setdefault("warnings", []).append(
+                f'{child["start_date"]} to {child["end_date"]}: chunk job {child["_id"]} did not complete.')
+            continue
+        result["per_date"].extend(child_result.get("per_date", []))
+        result.setdefault("warnings", []).extend(child_result.get("warnings", []))
+        add_counts(result["inserted"], child_result.get("inserted", {}))
+        result["rows_count"] += child_result.get("rows_count", 0)
+        result["rows_sample"].extend(child_result.get("rows_sample", [])[:2 - len(result["rows_sample"])])
+        result.setdefault("counts", child_result.get("counts"))
+    if not result.get("warnings"):
+        result.pop("warnings", None)
+
+    status = "Job Processed" if not failed else f"Job Failed: {failed} of {len(children)} chunks did not complete"
+    _jobs_collection().update_one(
+        {"_id": parent_job_id},
+        {"$set": {
+            "status": status,
+            "result": result,
+            "completed_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    release(parent_job_id)
+    result["queue_job_id"] = parent_job_id
+    result["finished_at"] = datetime.utcnow().isoformat() + "Z"
+    return result
@@ -0,0 +1,118 @@
+# services/queue/resume.py
+# Re-enqueue the unfinished dates of an interrupted or partly failed job
+from datetime import datetime, timedelta
+from rq.job import Dependency
+from config import GA_JOBS, RESUME_MAX_ATTEMPTS
+from db.mongo import get_db
+from services.queue.setup import ga_queue
+from services.queue import scheduler
+from services.queue.task_wrapper import enqueueable_run
+from services.queue.fanout import aggregate_children
+
+
+def _jobs_collection():
+    return get_db()[GA_JOBS]
+
+# statuses of a job that is (or may still be) waiting for a worker
+_ACTIVE_STATUSES = ("queued", "in_progress")
+
+
+class ResumeError(ValueError):
+    """The job cannot be resumed (unknown, still running, or not a combined date range)."""
+
+
+def _job_range(job):
+    # 'range' is written by run_ga when the run starts; incremental jobs only have it there
+    job_range = job.get("range") or {}
+    start_date = job_range.get("start_date") or job.get("start_date")
+    end_date = job_range.get("end_date") or job.get("end_date")
+    if job.get("mode", "combined") != "combined" or not (start_date and end_date):
+        raise ResumeError("only combined date-range jobs can be resumed")
+    return start_date, end_date
+
+
+def pending_dates(job):
+    """
+    Split the job's dates without a 'done' checkpoint into (retry, exhausted):
+    dates still within RESUME_MAX_ATTEMPTS resumes, and dates that used them all up.
+    """
+    start_date, end_date = _job_range(job)
+    checkpoints = job.get("checkpoints") or {}
+    # a job trimmed by coalescing only ever owned its listed dates
+    dates = job.get("dates")
+    if not dates:
+        dates = []
+        current = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+        while current <= end:
+            dates.append(current.strftime("%Y-%m-%d"))
+            current += timedelta(days=1)
+    retry, exhausted = [], []
+    for date_str in dates:
+        checkpoint = checkpoints.get(date_str) or {}
+        if checkpoint.get("status") != "done":
+            if checkpoint.get("attempts", 0) >= RESUME_MAX_ATTEMPTS:
+                exhausted.append(date_str)
+            else:
+                retry.append(date_str)
+    return retry, exhausted
+
+
+def _resume_single(job, job_timeout):
+    """Re-enqueue one job's retryable dates. Returns (summary, rq job or None)."""
+    retry, exhausted = pending_dates(job)
+    summary = {"job_id": job["_id"], "dates": retry, "exhausted": exhausted}
+    if not retry:
+        return summary, None
+
+    start_date, end_date = _job_range(job)
+    _jobs_collection().update_one(
+        {"_id": job["_id"]},
+        {"$set": {"status": "queued", "updated_at": datetime.now()},
+         "$inc": {"resumes": 1, **{f"checkpoints.{d}.attempts": 1 for d in retry}}}
+    )
+    property_id = job.get("property_id")
+    rq_job = scheduler.submit(property_id, enqueueable_run, (job.get("mode", "combined"), start_date, end_date),
+                              {"queue_job_id": job["_id"], "dates": retry, "property_id": property_id},
+                              job_timeout=job_timeout)
+    return summary, rq_job
+
+
+def resume_job(job_id, job_timeout=1000, force=False):
+    """
+    Re-enqueue only the dates of job_id that have no 'done' checkpoint (never reached,
+    failed, or filled with simulated data). For a fanned-out parent each unfinished
+    chunk is resumed and the parent re-aggregated once they finish.
+    A job still marked queued/in_progress is refused unless force=True, e.g. after
+    its worker was killed. Returns a summary of what was re-enqueued.
+    """
+    job = _jobs_collection().find_one({"_id": job_id})
+    if not job:
+        raise ResumeError("job_not_found")
+    if job.get("status") in _ACTIVE_STATUSES and not force:
+        raise ResumeError(f"job is {job['status']}; pass force to resume it anyway")
+
+    if not job.get("children"):
+        summary, rq_job = _resume_single(job, job_timeout)
+        summary["resumed"] = rq_job is not None
+        return summary
+
+    chunks = []
+    rq_jobs = []
+    for child in _jobs_collection().find({"parent_job_id": job_id}):
+        if child.get("status") in _ACTIVE_STATUSES and not force:
+            continue
+        summary, rq_job = _resume_single(child, job_timeout)
+        if rq_job is not None:
+            chunks.append(summary)
+            rq_jobs.append(rq_job)
+        elif summary["exhausted"]:
+            chunks.append(summary)
+    if rq_jobs:
+        _jobs_collection().update_one(
+            {"_id": job_id},
+            {"$set": {"status": "queued", "updated_at": datetime.now()}, "$inc": {"resumes": 1}}
+        )
+        ga_queue.enqueue(aggregate_children, job_id,
+                         depends_on=Dependency(jobs=rq_jobs, allow_failure=True))
+    return {"job_id": job_id, "resumed": bool(rq_jobs), "chunks": chunks}
@@ -0,0 +1,155 @@
+# services/queue/scheduler.py
+# Fair admission of GA jobs from many properties onto the shared ga_queue
+#
+# A property's jobs wait in a Redis list while it already has
+# GA_PROPERTY_MAX_ACTIVE_JOBS jobs queued or running; as slots free up, waiting
+# jobs are pushed to ga_queue one property at a time, in turn. A large backfill
+# so holds at most that many workers of the shared pool, and a small property's
+# job goes to the queue as soon as it is submitted. Each property's GA requests
+# still go through its own rate and quota budget (services.ga4.ratelimit).
+import logging
+import time
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+from config import GA_FAIR_SCHEDULING, GA_PROPERTY_MAX_ACTIVE_JOBS, GA_SCHEDULER_STALE_SECONDS
+from services.queue.setup import ga_queue, redis_conn
+
+_PREFIX = 'ga_sched:'
+# properties with waiting jobs, in turn order, and the same as a set for membership
+_RING = f'{_PREFIX}ring'
+_MEMBERS = f'{_PREFIX}members'
+
+# KEYS: pending list, ring, members; ARGV: job id, property
+_SUBMIT_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+if redis.call('SADD', KEYS[3], ARGV[2]) == 1 then
+  redis.call('RPUSH', KEYS[2], ARGV[2])
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# KEYS: ring, members; ARGV: key prefix, now, max active jobs, stale after (s), max admissions.
+# Visits the properties in ring order, admitting at most one job per property per
+# pass; a visited property moves to the back, so the next call starts with the next
+# one. Returns [property, job id, ...] of the admitted jobs.
+_DISPATCH_SCRIPT = """
+local prefix, now = ARGV[1], tonumber(ARGV[2])
+local cap, stale, max_admit = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local admitted = {}
+local progressed = true
+while progressed and #admitted < 2 * max_admit do
+  progressed = false
+  local n = redis.call('LLEN', KEYS[1])
+  for i = 1, n do
+    if #admitted >= 2 * max_admit then break end
+    local property = redis.call('LPOP', KEYS[1])
+    local pending = prefix .. 'pending:' .. property
+    local active = prefix .. 'active:' .. property
+    redis.call('ZREMRANGEBYSCORE', active, '-inf', now - stale)
+    if redis.call('LLEN', pending) == 0 then
+      redis.call('SREM', KEYS[2], property)
+    else
+      if redis.call('ZCARD', active) < cap then
+        local job_id = redis.call('LPOP', pending)
+        redis.call('ZADD', active, now, job_id)
+        admitted[#admitted + 1] = property
+        admitted[#admitted + 1] = job_id
+        progressed = true
+      end
+      redis.call('RPUSH', KEYS[1], property)
+    end
+  end
+end
+return admitted
+"""
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def submit(property_id, fn, args=(), kwargs=None, job_timeout=None):
+    """
+    Run fn(*args, **kwargs) on ga_queue as a job of property_id: enqueued now if
+    the property has a free slot, otherwise when its turn comes. Returns the RQ
+    job either way, so it can be a dependency (e.g. of a fan-out's aggregation).
+    Without a property, or with GA_FAIR_SCHEDULING off, the job is enqueued directly.
+    """
+    if not (GA_FAIR_SCHEDULING and property_id):
+        return ga_queue.enqueue_call(fn, args=args, kwargs=kwargs, timeout=job_timeout)
+    job = ga_queue.create_job(fn, args=args, kwargs=kwargs, timeout=job_timeout, meta={'property_id': property_id})
+    job.save()
+    try:
+        redis_conn.eval(_SUBMIT_SCRIPT, 3, f'{_PREFIX}pending:{property_id}', _RING, _MEMBERS, job.id, property_id)
+    except Exception as e:
+        logging.warning(f"Fair scheduling unavailable, job {job.id} enqueued directly: {e}")
+        return ga_queue.enqueue_job(job)
+    dispatch()
+    return job
+
+
+def dispatch(max_jobs=100):
+    """Push waiting jobs to ga_queue as their properties have room, taking properties in turn."""
+    if not GA_FAIR_SCHEDULING:
+        return []
+    try:
+        admitted = redis_conn.eval(_DISPATCH_SCRIPT, 2, _RING, _MEMBERS, _PREFIX, time.time(),
+                                   GA_PROPERTY_MAX_ACTIVE_JOBS, GA_SCHEDULER_STALE_SECONDS, max_jobs)
+    except Exception as e:
+        logging.warning(f"Could not dispatch waiting GA jobs: {e}")
+        return []
+    admitted = [_decode(v) for v in admitted]
+    jobs = []
+    for property_id, job_id in zip(admitted[::2], admitted[1::2]):
+        try:
+            job = Job.fetch(job_id, connection=redis_conn)
+        except NoSuchJobError:
+            # deleted while waiting: give its slot back
+            redis_conn.zrem(f'{_PREFIX}active:{property_id}', job_id)
+            continue
+        jobs.append(ga_queue.enqueue_job(job))
+    return jobs
+
+
+def finished(property_id, job_id):
+    """Free job_id's slot once it has run (whatever the outcome) and admit the next waiting jobs."""
+    if not (GA_FAIR_SCHEDULING and property_id and job_id):
+        return
+    try:
+        redis_conn.zrem(f'{_PREFIX}active:{property_id}', job_id)
+    except Exception as e:
+        logging.warning(f"Could not free the scheduler slot of job {job_id}: {e}")
+        return
+    dispatch()
+
+
+def recover():
+    """
+    Free the slots of jobs that will never report back (finished, failed or gone,
+    e.g. after workers were killed), then dispatch. Meant for worker startup.
+    """
+    if not GA_FAIR_SCHEDULING:
+        return
+    try:
+        for active in [_decode(k) for k in redis_conn.scan_iter(f'{_PREFIX}active:*')]:
+            for job_id in [_decode(j) for j in redis_conn.zrange(active, 0, -1)]:
+                try:
+                    status = Job.fetch(job_id, connection=redis_conn).get_status()
+                except NoSuchJobError:
+                    status = None
+                if status not in (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED):
+                    redis_conn.zrem(active, job_id)
+    except Exception as e:
+        logging.warning(f"Could not recover scheduler slots: {e}")
+    dispatch()
+
+
+def get_scheduler_stats():
+    """{property: {'waiting', 'active'}} for the properties with waiting or admitted jobs."""
+    stats = {}
+    properties = {_decode(p) for p in redis_conn.smembers(_MEMBERS)}
+    properties.update(_decode(k)[len(f'{_PREFIX}active:'):] for k in redis_conn.scan_iter(f'{_PREFIX}active:*'))
+    for property_id in sorted(properties):
+        stats[property_id] = {'waiting': redis_conn.llen(f'{_PREFIX}pending:{property_id}'),
+                              'active': redis_conn.zcard(f'{_PREFIX}active:{property_id}')}
+    return stats
@@ -1,14 +1,19 @@
 # services/queue/task_wrapper.py
 import importlib
 import inspect
+import logging
 import traceback
 from datetime import datetime
+from rq import get_current_job
 from config import GA_JOBS
-from db.mongo import init_mongo, get_db
+from db.mongo import get_db
+from services.queue.coalesce import release
+from services.queue import scheduler
+from services.ga4 import telemetry
 
-init_mongo()
-db = get_db()
-jobs_collection = db[GA_JOBS]
+def _jobs_collection():
+    # resolved per call: Mongo connects on first use, in the process (e.g. forked job) using it
+    return get_db()[GA_JOBS]
 
 # Configure the module path where your GA runner lives.
 # If your GA functions live at services.ga4.runner, that's default.
@@ -33,27 +38,105 @@ def _get_callable():
             return obj
     raise AttributeError(f"No callable GA runner found in {GA_RUNNER_MODULE}. Checked: {CANDIDATE_FNAMES}")
 
-def enqueueable_run(mode="combined", start_date=None, end_date=None, queue_job_id=None, job_timeout=None):
+# (runner, names of the parameters it accepts), resolved once per process
+_runner = None
+
+def _get_runner():
+    global _runner
+    if _runner is None:
+        fn = _get_callable()
+        _runner = (fn, set(inspect.signature(fn).parameters))
+    return _runner
+
+def preload(warm_client=False):
+    """
+    Import the GA runner with its heavy dependencies and resolve the runner once,
+    ahead of the first job. Call it in the worker before it starts: forked job
+    processes then inherit the loaded modules, and a SimpleWorker runs every job
+    without any import or lookup. warm_client also builds the GA client, which
+    only helps when jobs run in this process (it is rebuilt after a fork).
+    """
+    _get_runner()
+    from services.ga4.client import GA_INSTALLED, ga_types, api_exceptions, get_client
+    if GA_INSTALLED:
+        ga_types()
+        api_exceptions()
+        if warm_client:
+            try:
+                get_client()
+            except Exception as e:
+                # not fatal: the first job builds it (or falls back to simulation)
+                logging.warning(f"GA client not prebuilt: {e}")
+
+def _merge_resumed_result(job_doc, result):
+    """
+    Fold a resumed run (which only re-ran some dates) into what the job had already
+    done, so the stored result still covers the whole range. Earlier dates come from
+    the previous result or, if the job never finished, from its checkpoints.
+    """
+    if "per_date" not in result:
+        return result
+    previous = job_doc.get("result") if isinstance(job_doc.get("result"), dict) else {}
+    if "per_date" in previous:
+        earlier = previous["per_date"]
+    else:
+        earlier = [{"date": d, "inserted": c.get("inserted", {}), "rows_count": c.get("rows_count", 0)}
+                   for d, c in (job_doc.get("checkpoints") or {}).items() if c.get("status") == "done"]
+    by_date = {d["date"]: d for d in earlier}
+    by_date.update({d["date"]: d for d in result["per_date"]})
+    merged = dict(result)
+    merged["per_date"] = [by_date[d] for d in sorted(by_date)]
+    merged["rows_count"] = sum(d.get("rows_count", 0) for d in merged["per_date"])
+    merged["inserted"] = {}
+    for d in merged["per_date"]:
+        for k, v in d.get("inserted", {}).items():
+            merged["inserted"][k] = merged["inserted"].get(k, 0) + v
+    merged["rows_sample"] = result.get("rows_sample") or previous.get("rows_sample", [])
+    return merged
+
+def enqueueable_run(mode="combined", start_date=None, end_date=None, queue_job_id=None, job_timeout=None, incremental=False,
+                    dates=None, property_id=None):
     """
     The function meant to be enqueued by RQ. This wrapper is careful:
-      - looks up your real GA function dynamically
-      - inspects its signature
+      - looks up your real GA function dynamically (once per process)
+      - inspects its signature (once per process)
       - passes only the params that function accepts (non-breaking)
       - attaches job metadata in result
+      - frees the job's in-flight entries (services.queue.coalesce) and its
+        property's scheduler slot (services.queue.scheduler) however it ends
+    dates, when given, limits the run to those dates (used to resume a job or to
+    skip dates another in-flight job covers). property_id selects the GA4 property
+    (default GA4_PROPERTY_ID).
     """
-    fn = _get_callable()
-    sig = inspect.signature(fn)
+    try:
+        return _run_and_record(mode, start_date, end_date, queue_job_id, incremental, dates, property_id)
+    finally:
+        release(queue_job_id)
+        current = get_current_job()
+        scheduler.finished(property_id, current.id if current else None)
+        # a forked work horse exits after the job, so push its metrics now
+        telemetry.flush()
+
+def _run_and_record(mode, start_date, end_date, queue_job_id, incremental, dates, property_id):
+    """Call the GA runner and record the outcome on the job document."""
+    fn, params = _get_runner()
     call_kwargs = {}
 
     # Try to pass common names if accepted
-    if "mode" in sig.parameters:
+    if "mode" in params:
         call_kwargs["mode"] = mode
-    if "start_date" in sig.parameters:
+    if "start_date" in params:
         call_kwargs["start_date"] = start_date
-    if "end_date" in sig.parameters:
+    if "end_date" in params:
         call_kwargs["end_date"] = end_date
-    if "job_id" in sig.parameters:
+    if "job_id" in params:
         call_kwargs["job_id"] = queue_job_id
+    if incremental and "incremental" in params:
+        call_kwargs["incremental"] = incremental
+    if dates and "dates" in params:
+        call_kwargs["dates"] = dates
+    if property_id and "property_id" in params:
+        call_kwargs["property_id"] = property_id
 
     # If the function accepts *args/**kwargs, just call with these kw; otherwise safe mapping above
     try:
@@ -64,7 +147,7 @@ def enqueueable_run(mode="combined", start_date=None, end_date=None, queue_job_i
             result = fn(mode, start_date, end_date)
         except Exception as e:
             if queue_job_id:
-                jobs_collection.update_one(
+                _jobs_collection().update_one(
                     {"_id": queue_job_id},
                     {"$set": {
                         "status": f"Job Failed with error: {e}",
@@ -80,15 +163,32 @@ def enqueueable_run(mode="combined", start_date=None, end_date=None, queue_job_i
                 "called_with": call_kwargs,
                 "timestamp": datetime.utcnow().isoformat() + "Z",
             }
+    except Exception as e:
+        # record the failure so parents of fanned-out jobs can see it, then let RQ mark the job failed
+        if queue_job_id:
+            _jobs_collection().update_one(
+                {"_id": queue_job_id},
+                {"$set": {
+                    "status": f"Job Failed with error: {e}",
+                    "timings": telemetry.job_summary(),
+                    "completed_at": datetime.utcnow(),
+                    "updated_at": datetime.utcnow()
+                }}
+            )
+        raise
 
     # attach job_id and timestamp if provided
     if isinstance(result, dict):
         if queue_job_id:
             result.setdefault("queue_job_id", queue_job_id)
-            jobs_collection.update_one(
+            if dates:
+                job_doc = _jobs_collection().find_one({"_id": queue_job_id}, {"result": 1, "checkpoints": 1}) or {}
+                result = _merge_resumed_result(job_doc, result)
+            _jobs_collection().update_one(
                 {"_id": queue_job_id},
                 {"$set": {
                     "status": "Job Processed",
+                    "result": result,
                     "completed_at": datetime.utcnow(),
                     "updated_at": datetime.utcnow()
                 }}
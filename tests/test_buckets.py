@@ -0,0 +1,43 @@
+# Bucketed combined_dimensions storage (services.ga4.buckets)
+#
+#   pip install pytest mongomock && python -m pytest tests
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from services.ga4 import buckets  # noqa: E402
+
+
+def _row(page, sessions=1):
+    return {'property_id': '1', 'date': '2024-01-01', 'streamId': '9', 'country': 'US', 'deviceCategory': 'mobile',
+            'landingPagePlusQueryString': f'/p{page}', 'sessions': sessions}
+
+
+def test_full_bucket_overflows(monkeypatch):
+    monkeypatch.setattr(buckets, 'COMBINED_BUCKET_MAX_ROWS', 3)
+    db = mongomock.MongoClient().db
+    buckets.ensure_bucket_indexes(db)
+    outcomes, _ = buckets.write_rows([_row(i) for i in range(5)], db)
+    assert outcomes == ['inserted'] * 5
+    outcomes, _ = buckets.write_rows([_row(i) for i in range(7)], db)
+    assert outcomes == ['skipped'] * 5 + ['inserted'] * 2
+
+    stored = sorted((b['n'], b['k'], len(b['r'])) for b in db[buckets.COMBINED_BUCKET_COLLECTION].find())
+    assert stored == [(0, 3, 3), (1, 3, 3), (2, 1, 1)]
+
+    # a changed row is updated in the bucket that holds it, not copied into the last one
+    outcomes, changes = buckets.write_rows([_row(0, sessions=5)], db)
+    assert outcomes == ['modified'] and changes[0][1]['sessions'] == 1
+    assert db[buckets.COMBINED_BUCKET_COLLECTION].count_documents({}) == 3
+
+    rows = list(buckets.find_rows(db=db, ordered=True))
+    assert [r['landingPagePlusQueryString'] for r in rows] == [f'/p{i}' for i in range(7)]
+    assert rows[0]['sessions'] == 5
+
+
+def test_byte_budget_overflows(monkeypatch):
+    # a bucket always takes its first row, however large
+    monkeypatch.setattr(buckets, 'COMBINED_BUCKET_MAX_BYTES', 1)
+    db = mongomock.MongoClient().db
+    buckets.write_rows([_row(i) for i in range(4)], db)
+    assert sorted(b['k'] for b in db[buckets.COMBINED_BUCKET_COLLECTION].find()) == [1, 1, 1, 1]
@@ -0,0 +1,41 @@
+# Natural-key lookups of the loader (services.ga4.loader)
+#
+#   pip install pytest mongomock && python -m pytest tests
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from services.ga4.loader import _existing_docs  # noqa: E402
+
+KEYS = ['property_id', 'date', 'country', 'deviceCategory']
+
+
+def _key(date, country, device, property_id='1'):
+    return {'property_id': property_id, 'date': date, 'country': country, 'deviceCategory': device}
+
+
+def test_existing_docs_matches_whole_keys():
+    col = mongomock.MongoClient().db.rows
+    col.insert_many([dict(_key('2024-01-01', 'US', 'mobile'), _content_hash='a'),
+                     dict(_key('2024-01-01', 'US', 'desktop'), _content_hash='b'),
+                     dict(_key('2024-01-02', 'DE', 'mobile'), _content_hash='c'),
+                     dict(_key(None, 'US', 'mobile'), _content_hash='d'),
+                     dict(_key('2024-01-01', 'US', 'mobile', property_id='2'), _content_hash='e')])
+
+    filters = [_key('2024-01-01', 'US', 'mobile'), _key('2024-01-01', 'FR', 'desktop'),
+               _key('2024-01-02', 'DE', 'mobile'), _key(None, 'US', 'mobile')]
+    existing = _existing_docs(col, KEYS, filters)
+    # ('2024-01-01', 'US', 'desktop') matches the $in but is not a requested key
+    assert {k: d['_content_hash'] for k, d in existing.items()} == {
+        ('1', '2024-01-01', 'US', 'mobile'): 'a',
+        ('1', '2024-01-02', 'DE', 'mobile'): 'c',
+        ('1', None, 'US', 'mobile'): 'd',
+    }
+
+
+def test_existing_docs_without_date():
+    col = mongomock.MongoClient().db.ga_country
+    col.insert_many([{'property_id': '1', 'country': 'US', '_content_hash': 'a'},
+                     {'property_id': '1', 'country': 'DE', '_content_hash': 'b'}])
+    existing = _existing_docs(col, ['property_id', 'country'], [{'property_id': '1', 'country': 'DE'}])
+    assert list(existing) == [('1', 'DE')]
@@ -0,0 +1,53 @@
+# Rollups of combined_dimensions kept by deltas (services.ga4.rollups)
+#
+#   pip install pytest mongomock && python -m pytest tests
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from services.ga4 import rollups  # noqa: E402
+
+
+def _row(date, country, sessions):
+    return {'property_id': '1', 'date': date, 'country': country, 'deviceCategory': 'mobile',
+            'landingPagePlusQueryString': '/', 'streamId': '1', 'sessions': sessions}
+
+
+def _sessions(db, period='month'):
+    return {d['country']: d['sessions'] for d in rollups.read_rollups(period, ['country'], db=db)}
+
+
+def test_first_save_builds_from_stored_rows():
+    db = mongomock.MongoClient().db
+    # stored before rollups existed: never added, so must not be subtracted
+    old = _row('2024-01-01', 'US', 10)
+    db.combined_dimensions.insert_many([dict(old), _row('2024-01-02', 'DE', 7)])
+    new = _row('2024-01-01', 'US', 15)
+    db.combined_dimensions.update_one({'date': '2024-01-01'}, {'$set': {'sessions': 15}})
+    rollups.apply_changes([(new, old)], db)
+    assert _sessions(db) == {'US': 15, 'DE': 7}
+
+    # later saves move the rollups by their difference
+    db.combined_dimensions.update_one({'date': '2024-01-02'}, {'$set': {'sessions': 9}})
+    rollups.apply_changes([(_row('2024-01-02', 'DE', 9), _row('2024-01-02', 'DE', 7))], db)
+    assert _sessions(db) == {'US': 15, 'DE': 9}
+
+
+def test_failed_update_is_rebuilt(monkeypatch):
+    db = mongomock.MongoClient().db
+    db.combined_dimensions.insert_one(_row('2024-01-01', 'US', 10))
+    rollups.rebuild_all(db)
+
+    def fail(deltas, db):
+        raise RuntimeError('E11000')
+    db.combined_dimensions.update_one({}, {'$set': {'sessions': 12}})
+    monkeypatch.setattr(rollups, '_write_deltas', fail)
+    with pytest.raises(RuntimeError):
+        rollups.apply_changes([(_row('2024-01-01', 'US', 12), _row('2024-01-01', 'US', 10))], db)
+    monkeypatch.undo()
+    assert rollups.stale_dates(db) == ['2024-01-01']
+    assert _sessions(db, 'week') == {'US': 10}
+
+    rollups.rebuild_stale(db)
+    assert rollups.stale_dates(db) == []
+    assert _sessions(db, 'week') == {'US': 12}
@@ -1,6 +1,10 @@
-from config import GA_JOBS
-from rq import Worker
+from config import GA_JOBS, RQ_SIMPLE_WORKER
+from rq import Worker, SimpleWorker
 from services.queue.setup import ga_queue, redis_conn
+from db.mongo import init_mongo
+from services.ga4.loader import ensure_indexes
+from services.queue.task_wrapper import preload
+from services.queue import scheduler
 import logging
 import sys
 
@@ -12,6 +16,14 @@ logging.basicConfig(
 )
 
 if __name__ == "__main__":
-    worker = Worker([ga_queue], connection=redis_conn)
-    logging.info("🚀 RQ worker started and listening for GA queue jobs...")
+    init_mongo()
+    ensure_indexes()
+    # Load the runner and GA stack once here; a forking Worker's job processes inherit
+    # them, and open their own Mongo/GA connections (see db.mongo, services.ga4.client)
+    preload(warm_client=RQ_SIMPLE_WORKER)
+    # slots held by jobs of workers that died would otherwise block their property until they go stale
+    scheduler.recover()
+    worker_cls = SimpleWorker if RQ_SIMPLE_WORKER else Worker
+    worker = worker_cls([ga_queue], connection=redis_conn)
+    logging.info(f"🚀 RQ {worker_cls.__name__} started and listening for GA queue jobs...")
     worker.work(with_scheduler=True)